@@ -26,6 +26,25 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 target_metadata = Base.metadata
 
+PARTITIONED = [table.name for table in target_metadata.tables.values()
+               if table.dialect_options['postgresql'].get('partition_by')]
+
+
+def _partition(table) -> bool:
+    return table.name not in target_metadata.tables and any(
+        table.name.startswith(f'{parent}_') for parent in PARTITIONED)
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # partitions are created by tools.maintenance, and postgres copies indexes and foreign keys
+    # onto them by itself; autogenerate shouldn't offer to drop any of those
+    if not reflected:
+        return True
+    if type_ == 'foreign_key_constraint':
+        return not (_partition(object.table) or _partition(object.referred_table))
+    table = object if type_ == 'table' else getattr(object, 'table', None)
+    return table is None or not _partition(table)
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -50,6 +69,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -71,7 +91,8 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata,
+            include_object=include_object
         )
 
         with context.begin_transaction():
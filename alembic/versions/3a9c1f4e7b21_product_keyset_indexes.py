@@ -0,0 +1,28 @@
+"""product keyset indexes
+
+Revision ID: 3a9c1f4e7b21
+Revises: e7855bcb54e3
+Create Date: 2026-10-18 11:10:42.518303
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9c1f4e7b21'
+down_revision = 'e7855bcb54e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_products_created_at_id', 'products',
+                    ['created_at', 'id'], unique=False)
+    op.create_index('ix_products_price_id', 'products',
+                    ['price', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_products_price_id', table_name='products')
+    op.drop_index('ix_products_created_at_id', table_name='products')
@@ -0,0 +1,37 @@
+"""lookup and foreign key indexes
+
+Revision ID: 5b0e6d2a9f17
+Revises: 8e41b7d0c3a6
+Create Date: 2026-10-18 12:02:31.660284
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0e6d2a9f17'
+down_revision = '8e41b7d0c3a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # fails if duplicates slipped in through the old check-then-insert code; dedupe those first
+    op.create_index('ix_users_email', 'users', ['email'], unique=True)
+    op.create_index('ix_admins_username', 'admins', ['username'], unique=True)
+    op.create_index('ix_orders_user_id', 'orders', ['user_id'], unique=False)
+    op.create_index('ix_order_items_product_id', 'order_items',
+                    ['product_id'], unique=False)
+    op.create_index('ix_reviews_user_id', 'reviews', ['user_id'], unique=False)
+    op.create_index('ix_payments_order_id', 'payments',
+                    ['order_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_payments_order_id', table_name='payments')
+    op.drop_index('ix_reviews_user_id', table_name='reviews')
+    op.drop_index('ix_order_items_product_id', table_name='order_items')
+    op.drop_index('ix_orders_user_id', table_name='orders')
+    op.drop_index('ix_admins_username', table_name='admins')
+    op.drop_index('ix_users_email', table_name='users')
@@ -0,0 +1,38 @@
+"""product rating aggregates
+
+Revision ID: 8e41b7d0c3a6
+Revises: c5d28e0b94fa
+Create Date: 2026-10-18 11:41:55.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e41b7d0c3a6'
+down_revision = 'c5d28e0b94fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('products', sa.Column('rating_avg', sa.Float(),
+                  server_default=sa.text('0'), nullable=False))
+    op.add_column('products', sa.Column('rating_count', sa.Integer(),
+                  server_default=sa.text('0'), nullable=False))
+    op.execute("""
+        UPDATE products
+        SET rating_avg = r.rating_avg, rating_count = r.rating_count
+        FROM (SELECT product_id, avg(rating) AS rating_avg, count(*) AS rating_count
+              FROM reviews GROUP BY product_id) AS r
+        WHERE products.id = r.product_id
+    """)
+    op.create_index('ix_products_rating_avg_id', 'products',
+                    ['rating_avg', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_products_rating_avg_id', table_name='products')
+    op.drop_column('products', 'rating_count')
+    op.drop_column('products', 'rating_avg')
@@ -0,0 +1,171 @@
+"""partition orders by order_date
+
+Revision ID: a83f1c6e5d20
+Revises: d4a7c2e91b36
+Create Date: 2026-10-18 12:09:12.447905
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83f1c6e5d20'
+down_revision = 'd4a7c2e91b36'
+branch_labels = None
+depends_on = None
+
+TABLES = ('orders', 'order_items', 'payments')
+ORDER_COLUMNS = 'id, user_id, order_date, total_price, shipping_address, status, created_at, updated_at'
+ITEM_COLUMNS = 'order_id, order_date, product_id, quantity, price, created_at, updated_at'
+PAYMENT_COLUMNS = 'user_id, order_id, order_date, payment_date, amount, created_at, updated_at'
+
+
+def _timestamp(name, **kwargs):
+    return sa.Column(name, postgresql.TIMESTAMP(timezone=True), nullable=False, **kwargs)
+
+
+def _orders(name, partitioned, **id_options):
+    options = {'postgresql_partition_by': 'RANGE (order_date)'} if partitioned else {}
+    op.create_table(name,
+                    sa.Column('id', sa.Integer(), nullable=False, **id_options),
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    _timestamp('order_date'),
+                    sa.Column('total_price', sa.Float(), nullable=False),
+                    sa.Column('shipping_address', sa.String(length=1024), nullable=False),
+                    sa.Column('status', sa.String(length=32), nullable=False),
+                    _timestamp('created_at', server_default=sa.text('now()')),
+                    _timestamp('updated_at', server_default=sa.text('now()')),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE', onupdate='CASCADE'),
+                    sa.PrimaryKeyConstraint(*(['id', 'order_date'] if partitioned else ['id']), name=f'{name}_pkey'),
+                    **options)
+
+
+def _order_items(name, orders, partitioned):
+    options = {'postgresql_partition_by': 'RANGE (order_date)'} if partitioned else {}
+    key = ['order_id', 'order_date'] if partitioned else ['order_id']
+    op.create_table(name,
+                    sa.Column('order_id', sa.Integer(), nullable=False),
+                    *([_timestamp('order_date')] if partitioned else []),
+                    sa.Column('product_id', sa.Integer(), nullable=False),
+                    sa.Column('quantity', sa.Integer(), nullable=False),
+                    sa.Column('price', sa.Float(), nullable=False),
+                    _timestamp('created_at', server_default=sa.text('now()')),
+                    _timestamp('updated_at', server_default=sa.text('now()')),
+                    sa.ForeignKeyConstraint(key, [f'{orders}.{column}' for column in ['id', 'order_date'][:len(key)]],
+                                            ondelete='CASCADE', onupdate='CASCADE'),
+                    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ondelete='CASCADE', onupdate='CASCADE'),
+                    sa.PrimaryKeyConstraint(*key, 'product_id', name=f'{name}_pkey'),
+                    **options)
+
+
+def _payments(name, orders, partitioned):
+    options = {'postgresql_partition_by': 'RANGE (order_date)'} if partitioned else {}
+    key = ['order_id', 'order_date'] if partitioned else ['order_id']
+    op.create_table(name,
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('order_id', sa.Integer(), nullable=False),
+                    *([_timestamp('order_date')] if partitioned else []),
+                    _timestamp('payment_date'),
+                    sa.Column('amount', sa.Float(), nullable=False),
+                    _timestamp('created_at', server_default=sa.text('now()')),
+                    _timestamp('updated_at', server_default=sa.text('now()')),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE', onupdate='CASCADE'),
+                    sa.ForeignKeyConstraint(key, [f'{orders}.{column}' for column in ['id', 'order_date'][:len(key)]],
+                                            ondelete='CASCADE', onupdate='CASCADE'),
+                    sa.PrimaryKeyConstraint('user_id', *key, name=f'{name}_pkey'),
+                    **options)
+
+
+def upgrade() -> None:
+    # a table can't be turned into a partitioned one in place: build the new ones beside the
+    # old ones, copy the rows over and drop the old tables
+    for table in TABLES:
+        op.rename_table(table, f'{table}_unpartitioned')
+        op.execute(f'ALTER INDEX {table}_pkey RENAME TO {table}_unpartitioned_pkey')
+    op.drop_index('ix_orders_user_id_order_date_id', table_name='orders_unpartitioned')
+    op.drop_index('ix_order_items_product_id', table_name='order_items_unpartitioned')
+    op.drop_index('ix_payments_order_id', table_name='payments_unpartitioned')
+
+    _orders('orders', True, server_default=sa.text("nextval('orders_id_seq'::regclass)"))
+    _order_items('order_items', 'orders', True)
+    _payments('payments', 'orders', True)
+    _orders('orders_archive', True)
+    _order_items('order_items_archive', 'orders_archive', True)
+    _payments('payments_archive', 'orders_archive', True)
+    for table in TABLES:
+        op.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+        op.execute(f'CREATE TABLE {table}_archive_default PARTITION OF {table}_archive DEFAULT')
+
+    # a monthly partition per month of history, up to this one; tools.maintenance adds the next ones
+    op.execute("""
+        DO $$
+        DECLARE
+            month timestamp;
+            name text;
+        BEGIN
+            FOR month IN SELECT generate_series(date_trunc('month', min(order_date) AT TIME ZONE 'UTC'),
+                                                now() AT TIME ZONE 'UTC', interval '1 month')
+                         FROM orders_unpartitioned LOOP
+                FOREACH name IN ARRAY ARRAY['orders', 'order_items', 'payments'] LOOP
+                    EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                                   name || '_p' || to_char(month, 'YYYY_MM'), name,
+                                   month AT TIME ZONE 'UTC', (month + interval '1 month') AT TIME ZONE 'UTC');
+                END LOOP;
+            END LOOP;
+        END
+        $$
+    """)
+
+    op.execute(f'INSERT INTO orders ({ORDER_COLUMNS}) SELECT {ORDER_COLUMNS} FROM orders_unpartitioned')
+    op.execute(f"""
+        INSERT INTO order_items ({ITEM_COLUMNS})
+        SELECT i.order_id, o.order_date, i.product_id, i.quantity, i.price, i.created_at, i.updated_at
+        FROM order_items_unpartitioned AS i JOIN orders_unpartitioned AS o ON o.id = i.order_id
+    """)
+    op.execute(f"""
+        INSERT INTO payments ({PAYMENT_COLUMNS})
+        SELECT p.user_id, p.order_id, o.order_date, p.payment_date, p.amount, p.created_at, p.updated_at
+        FROM payments_unpartitioned AS p JOIN orders_unpartitioned AS o ON o.id = p.order_id
+    """)
+    op.execute('ALTER SEQUENCE orders_id_seq OWNED BY orders.id')
+    op.drop_table('payments_unpartitioned')
+    op.drop_table('order_items_unpartitioned')
+    op.drop_table('orders_unpartitioned')
+
+    op.create_index('ix_orders_user_id_order_date_id', 'orders',
+                    ['user_id', 'order_date', 'id'], unique=False)
+    op.create_index('ix_order_items_product_id', 'order_items', ['product_id'], unique=False)
+    op.create_index('ix_payments_order_id', 'payments', ['order_id'], unique=False)
+    op.create_index('ix_orders_archive_user_id', 'orders_archive', ['user_id'], unique=False)
+    op.create_index('ix_order_items_archive_product_id', 'order_items_archive', ['product_id'], unique=False)
+
+
+def downgrade() -> None:
+    # archived orders go back into the single tables too
+    _orders('orders_unpartitioned', False, server_default=sa.text("nextval('orders_id_seq'::regclass)"))
+    _order_items('order_items_unpartitioned', 'orders_unpartitioned', False)
+    _payments('payments_unpartitioned', 'orders_unpartitioned', False)
+    for suffix in ('', '_archive'):
+        op.execute(f'INSERT INTO orders_unpartitioned ({ORDER_COLUMNS}) SELECT {ORDER_COLUMNS} FROM orders{suffix}')
+        op.execute(f"""
+            INSERT INTO order_items_unpartitioned ({ITEM_COLUMNS.replace('order_date, ', '')})
+            SELECT {ITEM_COLUMNS.replace('order_date, ', '')} FROM order_items{suffix}
+        """)
+        op.execute(f"""
+            INSERT INTO payments_unpartitioned ({PAYMENT_COLUMNS.replace('order_date, ', '')})
+            SELECT {PAYMENT_COLUMNS.replace('order_date, ', '')} FROM payments{suffix}
+        """)
+    op.execute('ALTER SEQUENCE orders_id_seq OWNED BY orders_unpartitioned.id')
+    # dropping a partitioned table drops its partitions
+    for table in ('payments_archive', 'order_items_archive', 'orders_archive', 'payments', 'order_items', 'orders'):
+        op.drop_table(table)
+    for table in TABLES:
+        op.rename_table(f'{table}_unpartitioned', table)
+        op.execute(f'ALTER INDEX {table}_unpartitioned_pkey RENAME TO {table}_pkey')
+
+    op.create_index('ix_orders_user_id_order_date_id', 'orders',
+                    ['user_id', 'order_date', 'id'], unique=False)
+    op.create_index('ix_order_items_product_id', 'order_items', ['product_id'], unique=False)
+    op.create_index('ix_payments_order_id', 'payments', ['order_id'], unique=False)
@@ -0,0 +1,30 @@
+"""product stock
+
+Revision ID: b5e8a3f61c94
+Revises: f2b9d47c0e15
+Create Date: 2026-10-18 12:19:03.128456
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e8a3f61c94'
+down_revision = 'f2b9d47c0e15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # nullable without a default: existing products stay untracked and the table isn't rewritten
+    op.add_column('products', sa.Column('stock', sa.Integer(), nullable=True))
+    # validated after the ALTER has committed, so the scan doesn't hold its ACCESS EXCLUSIVE lock
+    op.execute('ALTER TABLE products ADD CONSTRAINT ck_products_stock CHECK (stock >= 0) NOT VALID')
+    with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE products VALIDATE CONSTRAINT ck_products_stock')
+
+
+def downgrade() -> None:
+    op.drop_constraint('ck_products_stock', 'products', type_='check')
+    op.drop_column('products', 'stock')
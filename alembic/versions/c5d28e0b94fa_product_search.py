@@ -0,0 +1,33 @@
+"""product search
+
+Revision ID: c5d28e0b94fa
+Revises: 3a9c1f4e7b21
+Create Date: 2026-10-18 11:24:09.731448
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d28e0b94fa'
+down_revision = '3a9c1f4e7b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.add_column('products', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(
+        "setweight(to_tsvector('english', name), 'A') || setweight(to_tsvector('english', description), 'B')", persisted=True), nullable=True))
+    op.create_index('ix_products_search_vector', 'products',
+                    ['search_vector'], unique=False, postgresql_using='gin')
+    op.create_index('ix_products_name_trgm', 'products', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_products_name_trgm', table_name='products')
+    op.drop_index('ix_products_search_vector', table_name='products')
+    op.drop_column('products', 'search_vector')
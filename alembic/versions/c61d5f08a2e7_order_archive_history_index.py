@@ -0,0 +1,28 @@
+"""order archive history index
+
+Revision ID: c61d5f08a2e7
+Revises: b5e8a3f61c94
+Create Date: 2026-10-18 13:02:31.664170
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c61d5f08a2e7'
+down_revision = 'b5e8a3f61c94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # the order history pages through archived orders too, by the same key as the live ones
+    op.create_index('ix_orders_archive_user_id_order_date_id', 'orders_archive',
+                    ['user_id', 'order_date', 'id'], unique=False)
+    op.drop_index('ix_orders_archive_user_id', table_name='orders_archive')
+
+
+def downgrade() -> None:
+    op.create_index('ix_orders_archive_user_id', 'orders_archive', ['user_id'], unique=False)
+    op.drop_index('ix_orders_archive_user_id_order_date_id', table_name='orders_archive')
@@ -0,0 +1,28 @@
+"""order history index
+
+Revision ID: d4a7c2e91b36
+Revises: 5b0e6d2a9f17
+Create Date: 2026-10-18 12:05:47.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7c2e91b36'
+down_revision = '5b0e6d2a9f17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # leads with user_id, so it also serves the foreign key lookups ix_orders_user_id was for
+    op.create_index('ix_orders_user_id_order_date_id', 'orders',
+                    ['user_id', 'order_date', 'id'], unique=False)
+    op.drop_index('ix_orders_user_id', table_name='orders')
+
+
+def downgrade() -> None:
+    op.create_index('ix_orders_user_id', 'orders', ['user_id'], unique=False)
+    op.drop_index('ix_orders_user_id_order_date_id', table_name='orders')
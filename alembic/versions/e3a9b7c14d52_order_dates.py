@@ -0,0 +1,52 @@
+"""order dates
+
+Revision ID: e3a9b7c14d52
+Revises: c61d5f08a2e7
+Create Date: 2026-10-18 13:41:09.215533
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a9b7c14d52'
+down_revision = 'c61d5f08a2e7'
+branch_labels = None
+depends_on = None
+
+# as in app/models.py
+RECORD_ORDER_DATES = '''
+CREATE OR REPLACE FUNCTION record_order_dates() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO order_dates (id, order_date) SELECT id, order_date FROM inserted ON CONFLICT (id) DO NOTHING;
+    RETURN NULL;
+END
+$$
+'''
+ORDER_DATES_TRIGGER = '''
+CREATE TRIGGER orders_record_order_dates AFTER INSERT ON orders
+REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE FUNCTION record_order_dates()
+'''
+
+
+def upgrade() -> None:
+    op.create_table('order_dates',
+                    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('order_date', postgresql.TIMESTAMP(timezone=True), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+    # the trigger first, so no order placed during the backfill is missed
+    op.execute(RECORD_ORDER_DATES)
+    op.execute(ORDER_DATES_TRIGGER)
+    op.execute('''
+        INSERT INTO order_dates (id, order_date)
+        SELECT id, order_date FROM orders UNION ALL SELECT id, order_date FROM orders_archive
+        ON CONFLICT (id) DO NOTHING
+    ''')
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER orders_record_order_dates ON orders')
+    op.execute('DROP FUNCTION record_order_dates()')
+    op.drop_table('order_dates')
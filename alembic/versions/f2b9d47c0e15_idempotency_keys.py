@@ -0,0 +1,36 @@
+"""idempotency keys
+
+Revision ID: f2b9d47c0e15
+Revises: a83f1c6e5d20
+Create Date: 2026-10-18 12:14:38.905112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b9d47c0e15'
+down_revision = 'a83f1c6e5d20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('idempotency_keys',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('key', sa.String(length=255), nullable=False),
+                    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+                    sa.Column('status_code', sa.Integer(), nullable=True),
+                    sa.Column('response', sa.Text(), nullable=True),
+                    sa.Column('created_at', postgresql.TIMESTAMP(timezone=True),
+                              server_default=sa.text('now()'), nullable=False),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE', onupdate='CASCADE'),
+                    sa.PrimaryKeyConstraint('user_id', 'key'))
+    op.create_index('ix_idempotency_keys_created_at', 'idempotency_keys', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_idempotency_keys_created_at', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from .config import settings
+
+
+class TTLCache:
+    # in-process LRU whose entries also expire after ttl seconds
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryBackend:
+    # per-process cache; each worker keeps its own copy
+    def __init__(self, namespace: str, maxsize: int, ttl: float):
+        self.namespace = namespace
+        self._cache = TTLCache(maxsize, ttl)
+        self._counters = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: bytes):
+        self._cache.set(key, value)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._cache.delete(key)
+
+    async def counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+    async def incr(self, key: str) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+
+class RedisBackend:
+    # shared by every worker pointed at the same redis
+    def __init__(self, namespace: str, url: str, ttl: float):
+        import redis.asyncio
+
+        self.namespace = namespace
+        self.ttl = ttl
+        self._redis = redis.asyncio.from_url(url)
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._redis.get(self._key(key))
+
+    async def set(self, key: str, value: bytes):
+        await self._redis.set(self._key(key), value, ex=int(self.ttl))
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self._redis.delete(*(self._key(key) for key in keys))
+
+    async def counter(self, key: str) -> int:
+        return int(await self._redis.get(self._key(key)) or 0)
+
+    async def incr(self, key: str) -> int:
+        return await self._redis.incr(self._key(key))
+
+
+def create_backend(namespace: str, maxsize: int, ttl: float):
+    if settings.cache_backend == 'redis':
+        return RedisBackend(namespace, settings.cache_url, ttl)
+    return MemoryBackend(namespace, maxsize, ttl)
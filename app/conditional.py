@@ -0,0 +1,41 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response, status
+
+
+def validators(tag: str, id: int, updated_at: datetime, variant: Optional[str] = None) -> dict:
+    # the same row serializes differently per ?expand, so the variant is part of the etag
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    digest = hashlib.sha1(
+        f"{tag}:{id}:{updated_at.isoformat()}:{variant or ''}".encode()).hexdigest()[:20]
+    return {
+        'ETag': f'W/"{digest}"',
+        'Last-Modified': format_datetime(updated_at.astimezone(timezone.utc), usegmt=True),
+    }
+
+
+def _etags(header: str) -> list:
+    return [etag.strip().removeprefix('W/') for etag in header.split(',') if etag.strip()]
+
+
+def not_modified(request: Request, headers: dict) -> Optional[Response]:
+    # If-None-Match wins over If-Modified-Since when a client sends both (RFC 9110 13.2.2)
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        etags = _etags(if_none_match)
+        matched = '*' in etags or headers['ETag'].removeprefix('W/') in etags
+    else:
+        try:
+            since = parsedate_to_datetime(request.headers['if-modified-since'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        matched = parsedate_to_datetime(headers['Last-Modified']) <= since
+    if matched:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return None
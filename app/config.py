@@ -1,3 +1,5 @@
+from typing import Literal, Optional
+
 from pydantic import BaseSettings
 
 
@@ -10,6 +12,48 @@ class Settings(BaseSettings):
     secret_key: str
     algorithm: str
     access_token_expire_minutes: int
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    # for PgBouncer in transaction mode: no client-side pool, no cached prepared statements, uniquely
+    # named ones (have PgBouncer run DISCARD ALL between clients, server_reset_query_always = 1,
+    # or they pile up on the server connections)
+    db_pgbouncer: bool = False
+    # comma-separated host:port of read replicas
+    database_replicas: str = ''
+    replica_retry_seconds: int = 30
+    replica_sticky_seconds: int = 5
+    bcrypt_rounds: int = 12
+    password_hash_workers: int = 4
+    password_hash_queue_limit: int = 64
+    principal_cache_size: int = 10000
+    principal_cache_ttl: int = 60
+    cache_backend: Literal['memory', 'redis'] = 'memory'
+    cache_url: Optional[str] = None
+    product_cache_size: int = 1000
+    product_cache_ttl: int = 30
+    export_batch_size: int = 1000
+    import_batch_size: int = 5000
+    # a checkout waiting longer than this for a hot product's row lock gets a 503 instead of queueing
+    stock_lock_timeout_ms: int = 2000
+    # how long a repeat of POST /orders/ with the same Idempotency-Key gets the stored response
+    idempotency_key_ttl: int = 86400
+    # POST /login token buckets, per client IP and per username: a burst, then so many attempts a minute.
+    # behind a proxy the client IP comes from X-Forwarded-For only if FORWARDED_ALLOW_IPS trusts it
+    # (see gunicorn.conf.py), otherwise all clients share the proxy's bucket
+    login_rate_limit: bool = True
+    login_ip_burst: int = 20
+    login_ip_per_minute: float = 20
+    login_username_burst: int = 5
+    login_username_per_minute: float = 5
+    login_rate_limit_keys: int = 100000
+    # refuse to start when the database is behind the Alembic head
+    schema_check: bool = True
+    sql_debug: bool = False
+    sql_debug_threshold: int = 5
+    sql_debug_history: int = 100
 
     class Config:
         env_file = ".env"
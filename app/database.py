@@ -1,15 +1,64 @@
-from sqlalchemy import create_engine
+import itertools
+import time
+from uuid import uuid4
+
+from fastapi import Request, Response
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from .config import settings
+from .metrics import TimedAsyncAdaptedQueuePool, TimedQueuePool, instrument_engine, instrument_pool
 
 
 DATABASE_URL = f"postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
+
+
+def _pool_options(poolclass, pre_ping: bool = settings.db_pool_pre_ping) -> dict:
+    if settings.db_pgbouncer:
+        # PgBouncer (transaction pooling) owns the server connections, so don't hold any here
+        return {'poolclass': NullPool}
+    return {'poolclass': poolclass, 'pool_size': settings.db_pool_size, 'max_overflow': settings.db_max_overflow,
+            'pool_timeout': settings.db_pool_timeout, 'pool_recycle': settings.db_pool_recycle, 'pool_pre_ping': pre_ping}
+
 
-engine = create_engine(DATABASE_URL)
+# a server connection can serve a different client after every transaction, so asyncpg
+# must not keep prepared statements around between them. it still prepares every statement,
+# under names numbered per client connection (__asyncpg_stmt_1__, ...) that collide with the
+# ones another client left on the same server connection; unique names can't
+ASYNC_CONNECT_ARGS = {'statement_cache_size': 0, 'prepared_statement_cache_size': 0,
+                      'prepared_statement_name_func': lambda: f'__asyncpg_{uuid4()}__'} if settings.db_pgbouncer else {}
+
+# sync engine, kept for Alembic and scripts
+engine = create_engine(DATABASE_URL, **_pool_options(TimedQueuePool))
+instrument_engine(engine, 'sync')
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# async engine used by the API routes
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL, connect_args=ASYNC_CONNECT_ARGS, **_pool_options(TimedAsyncAdaptedQueuePool))
+instrument_engine(async_engine.sync_engine, 'async')
+
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False)
+
+# read replicas, same credentials and database as the primary; pre-ping so a dead replica
+# fails at checkout, where get_read_db can still fail over
+replica_engines = [
+    create_async_engine(
+        f"postgresql+asyncpg://{settings.database_username}:{settings.database_password}@{host}/{settings.database_name}",
+        connect_args=ASYNC_CONNECT_ARGS, **_pool_options(TimedAsyncAdaptedQueuePool, pre_ping=True))
+    for host in filter(None, (host.strip() for host in settings.database_replicas.split(',')))]
+for index, replica_engine in enumerate(replica_engines):
+    instrument_engine(replica_engine.sync_engine, f'replica{index}')
+
+# set after a commit so the same client reads its own writes from the primary for a while
+PRIMARY_COOKIE = 'read_primary'
+
 Base = declarative_base()
 
 
@@ -21,6 +70,85 @@ def get_db():
         db.close()
 
 
+class ReplicaSet:
+    # round robin over the replicas, skipping one for replica_retry_seconds after it failed
+    def __init__(self, engines: list):
+        self.engines = engines
+        self._turn = itertools.count()
+        self._down_until = {}
+
+    def candidates(self) -> list:
+        if not self.engines:
+            return []
+        start, now = next(self._turn), time.monotonic()
+        rotated = self.engines[start % len(self.engines):] + self.engines[:start % len(self.engines)]
+        return [engine for engine in rotated if self._down_until.get(engine, 0) <= now]
+
+    def mark_down(self, engine):
+        self._down_until[engine] = time.monotonic() + settings.replica_retry_seconds
+
+
+replicas = ReplicaSet(replica_engines)
+
+
+async def connect_read() -> AsyncConnection:
+    # a connection to a healthy replica, or to the primary when none is reachable
+    for engine in replicas.candidates():
+        try:
+            return await engine.connect()
+        except (OSError, DBAPIError):
+            replicas.mark_down(engine)
+    return await async_engine.connect()
+
+
+async def get_async_db(response: Response):
+    async with AsyncSessionLocal() as db:
+        if replica_engines and settings.replica_sticky_seconds:
+            event.listen(db.sync_session, 'after_commit', lambda session: response.set_cookie(
+                PRIMARY_COOKIE, '1', max_age=settings.replica_sticky_seconds, httponly=True))
+        yield db
+
+
+async def get_read_db(request: Request):
+    # for read-only endpoints; anything that writes, or reads to decide a write, stays on get_async_db
+    if not replica_engines or request.cookies.get(PRIMARY_COOKIE):
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
+    conn = await connect_read()
+    try:
+        async with AsyncSessionLocal(bind=conn) as db:
+            yield db
+    finally:
+        await conn.close()
+
+
+def _labelled_engines() -> list:
+    # the labels given to instrument_engine above
+    return [('async', async_engine.sync_engine), ('sync', engine)] + [
+        (f'replica{index}', replica_engine.sync_engine) for index, replica_engine in enumerate(replica_engines)]
+
+
+def dispose_inherited():
+    # after a fork: drop pooled connections copied from the parent without closing them,
+    # they belong to the parent's sockets
+    for label, pool_engine in _labelled_engines():
+        pool_engine.dispose(close=False)
+        instrument_pool(pool_engine, label)
+
+
+def pool_stats() -> list:
+    stats = []
+    for name, pool_engine in _labelled_engines():
+        pool = pool_engine.pool
+        stat = {'engine': name, 'pool': type(pool).__name__, 'status': pool.status()}
+        if hasattr(pool, 'checkedout'):
+            stat.update(size=pool.size(), checked_out=pool.checkedout(), checked_in=pool.checkedin(),
+                        overflow=max(pool.overflow(), 0), timeout=pool.timeout())
+        stats.append(stat)
+    return stats
+
+
 # @app.middleware("http")
 # async def db_session_middleware(request, call_next):
 #     response = None
@@ -0,0 +1,17 @@
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+
+def expand_options(expand: Optional[str], expansions: dict) -> list:
+    # ?expand=orders,reviews -> the loader options registered for those names; a name may
+    # register a tuple of options
+    names = [name.strip() for name in (expand or '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in expansions]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Cannot expand {', '.join(unknown)}, expected one of: {', '.join(expansions)}")
+    options = []
+    for name in dict.fromkeys(names):
+        options.extend(expansions[name] if isinstance(expansions[name], tuple) else [expansions[name]])
+    return options
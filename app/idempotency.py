@@ -0,0 +1,54 @@
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response, status
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .config import settings
+
+keys = models.IdempotencyKey.__table__
+
+
+def fingerprint(request: Request, body: str) -> str:
+    return hashlib.sha256(f'{request.method} {request.url.path}\n{body}'.encode()).hexdigest()
+
+
+def _replay(row, fingerprint: str) -> Response:
+    if row.fingerprint != fingerprint:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Idempotency-Key was already used for a different request")
+    if row.response is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="A request with this Idempotency-Key is still in progress")
+    return Response(content=row.response, status_code=row.status_code, media_type='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
+
+
+async def claim(db: AsyncSession, user_id: int, key: str, fingerprint: str) -> Optional[Response]:
+    # None when this request owns the key and has to do the work, else the stored response.
+    # a finished repeat costs one primary key lookup; the insert runs in the caller's transaction,
+    # so a concurrent repeat blocks on the key until that commits (then replays) or rolls back
+    # (then owns the key itself)
+    pk = (keys.c.user_id == user_id, keys.c.key == key)
+    expired = datetime.now(timezone.utc) - timedelta(seconds=settings.idempotency_key_ttl)
+    row = (await db.execute(select(keys).filter(*pk))).one_or_none()
+    if row is not None and row.created_at >= expired:
+        return _replay(row, fingerprint)
+
+    # an expired key is taken over in place, `tools.maintenance expire-keys` may not have run yet
+    claimed = await db.scalar(insert(keys).values(user_id=user_id, key=key, fingerprint=fingerprint).on_conflict_do_update(
+        index_elements=[keys.c.user_id, keys.c.key], where=keys.c.created_at < expired,
+        set_={'fingerprint': fingerprint, 'status_code': None, 'response': None, 'created_at': func.now()}).returning(keys.c.key))
+    if claimed is not None:
+        return None
+    return _replay((await db.execute(select(keys).filter(*pk))).one(), fingerprint)
+
+
+async def save(db: AsyncSession, user_id: int, key: str, status_code: int, body: str):
+    # stored in the same transaction as the work, so a committed key always has its response
+    await db.execute(update(keys).filter(keys.c.user_id == user_id, keys.c.key == key).values(
+        status_code=status_code, response=body))
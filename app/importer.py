@@ -0,0 +1,122 @@
+import csv
+import json
+from itertools import islice
+from typing import IO, Iterable, Iterator, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy import String, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from . import models, schemas
+from .config import settings
+
+STAGING_COLUMNS = ['line', 'id', 'name', 'description',
+                   'price', 'image_url', 'stock', 'created_at']
+
+MAX_REPORTED_ERRORS = 1000
+
+
+def read_records(file: IO[str], format: str) -> Iterator[Tuple[int, dict]]:
+    # yields (line number, raw record); csv line numbers count the header as line 1
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, {key: value for key, value in record.items() if key is not None and value != ''}
+        return
+    for line_num, line in enumerate(file, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_num, record
+
+
+def _validate(line: int, record, seen_ids: set):
+    if not isinstance(record, dict):
+        return None, 'not a valid JSON object'
+    try:
+        product = schemas.CreateProduct(**record)
+        id = int(record['id']) if record.get('id') is not None else None
+    except ValidationError as e:
+        return None, [f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()]
+    except (TypeError, ValueError):
+        return None, 'id: value is not a valid integer'
+    for name, value in product.dict().items():
+        column = models.Product.__table__.c[name]
+        if isinstance(column.type, String) and column.type.length and len(value) > column.type.length:
+            return None, f'{name}: longer than {column.type.length} characters'
+    if id is not None:
+        if id in seen_ids:
+            return None, f'id: product {id} appears more than once'
+        seen_ids.add(id)
+    return (line, id, product.name, product.description, product.price, product.image_url, product.stock, product.created_at), None
+
+
+def _read_batch(records: Iterator[Tuple[int, dict]], seen_ids: set):
+    # reads (the upload is a blocking spooled file) and validates the next batch; run in a
+    # worker thread, a large import would otherwise stall every request on the event loop
+    batch = list(islice(records, settings.import_batch_size))
+    rows, rejected = [], []
+    for line, record in batch:
+        row, error = _validate(line, record, seen_ids)
+        if error:
+            rejected.append((line, error))
+        else:
+            rows.append(row)
+    return len(batch), rows, rejected
+
+
+async def import_products(conn: AsyncConnection, records: Iterable[Tuple[int, dict]]):
+    # records with an id update that product and the rest are inserted; valid rows are COPYed into
+    # a staging table batch by batch and merged with two set-based statements in the caller's
+    # transaction, invalid ones are skipped and reported by line number
+    errors, failed, seen_ids = [], 0, set()
+
+    def reject(line: int, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'line': line, 'errors': error if isinstance(error, list) else [error]})
+
+    await conn.execute(text("""
+        CREATE TEMPORARY TABLE product_import (
+            line integer NOT NULL, id integer, name text NOT NULL, description text NOT NULL,
+            price double precision NOT NULL, image_url text NOT NULL, stock integer, created_at timestamptz
+        )
+    """))
+    # the staging table above opened the transaction, so COPY on the driver connection joins it
+    driver = (await conn.get_raw_connection()).driver_connection
+    records = iter(records)
+    while True:
+        read, rows, rejected = await run_in_threadpool(_read_batch, records, seen_ids)
+        if not read:
+            break
+        for line, error in rejected:
+            reject(line, error)
+        if rows:
+            await driver.copy_records_to_table('product_import', records=rows, columns=STAGING_COLUMNS)
+
+    for line, id in (await conn.execute(text("""
+        SELECT line, id FROM product_import AS s
+        WHERE id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM products WHERE products.id = s.id)
+        ORDER BY line
+    """))).all():
+        reject(line, f'id: product {id} does not exist')
+    updated = (await conn.execute(text("""
+        UPDATE products
+        SET name = s.name, description = s.description, price = s.price, image_url = s.image_url,
+            stock = coalesce(s.stock, products.stock), created_at = coalesce(s.created_at, products.created_at), updated_at = now()
+        FROM product_import AS s
+        WHERE s.id = products.id
+        RETURNING products.id
+    """))).scalars().all()
+    inserted = (await conn.execute(text("""
+        INSERT INTO products (name, description, price, image_url, stock, created_at)
+        SELECT name, description, price, image_url, stock, coalesce(created_at, now())
+        FROM product_import WHERE id IS NULL ORDER BY line
+    """))).rowcount
+    await conn.execute(text("DROP TABLE product_import"))
+    errors.sort(key=lambda error: error['line'])
+    return {'inserted': inserted, 'updated': len(updated), 'failed': failed, 'errors': errors}, updated
@@ -0,0 +1,55 @@
+from typing import Dict, List, Tuple
+
+from sqlalchemy import Integer, any_, bindparam, cast, func, select, update
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+
+products = models.Product.__table__
+order_items = models.OrderItem.__table__
+
+
+def _locked(requested):
+    # every statement that changes stock locks its rows in product id order first, so two orders
+    # sharing products can't deadlock; untracked (NULL) stock is never locked. FOR NO KEY UPDATE
+    # like the UPDATE itself: a plain FOR UPDATE would also wait on (and block) the key share locks
+    # other checkouts' order_items foreign key checks hold on the same products
+    return select(products.c.id, products.c.stock).join(requested, requested.c.id == products.c.id).filter(
+        products.c.stock.is_not(None)).order_by(products.c.id).with_for_update(of=products, key_share=True).cte('locked')
+
+
+def _requested(quantities: Dict[int, int]):
+    return select(func.unnest(cast(bindparam('ids'), ARRAY(Integer))).label('id'),
+                  func.unnest(cast(bindparam('quantities'), ARRAY(Integer))).label('quantity')).cte('requested'), {
+        'ids': list(quantities), 'quantities': list(quantities.values())}
+
+
+async def reserve(db: AsyncSession, quantities: Dict[int, int]) -> Tuple[List[int], List[dict]]:
+    # takes the stock for every item in one statement: each product is decremented only if it
+    # has enough left, and the caller rolls back unless the returned shortfall list is empty.
+    # run it last in the transaction, the row locks are held until commit. returns the ids of
+    # the products whose stock changed too, their cached copies are stale after the commit
+    requested, params = _requested(quantities)
+    locked = _locked(requested)
+    reserved = update(products).values(stock=products.c.stock - requested.c.quantity, updated_at=func.now()).filter(
+        products.c.id == locked.c.id, requested.c.id == locked.c.id,
+        products.c.stock >= requested.c.quantity).returning(products.c.id).cte('reserved')
+    rows = (await db.execute(select(locked.c.id, locked.c.stock, reserved.c.id.is_not(None)).select_from(
+        locked.outerjoin(reserved, reserved.c.id == locked.c.id)).order_by(locked.c.id), params)).all()
+    return ([id for id, _, taken in rows if taken],
+            [{'product_id': id, 'available': stock} for id, stock, taken in rows if not taken])
+
+
+async def restock(db: AsyncSession, order_ids: List[int]) -> List[int]:
+    # puts the items of cancelled orders back; returns the ids of the products whose stock changed.
+    # the ids go in as one array parameter, a bulk cancel can exceed the bind parameter limit
+    quantities = dict((await db.execute(select(order_items.c.product_id, func.sum(order_items.c.quantity)).filter(
+        order_items.c.order_id == any_(cast(bindparam('order_ids'), ARRAY(Integer)))).group_by(order_items.c.product_id),
+        {'order_ids': list(order_ids)})).all())
+    if not quantities:
+        return []
+    requested, params = _requested(quantities)
+    locked = _locked(requested)
+    return (await db.execute(update(products).values(stock=products.c.stock + requested.c.quantity, updated_at=func.now()).filter(
+        products.c.id == locked.c.id, requested.c.id == locked.c.id).returning(products.c.id), params)).scalars().all()
@@ -1,15 +1,20 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from .database import engine
-from . import models
-from .routers import admin, user, product, auth, order
+from .config import settings
+from .database import async_engine
+from . import migrations, sqltrace
+from .metrics import MetricsMiddleware, metrics_endpoint
+from .routers import admin, user, product, auth, order, export
 
 
-models.Base.metadata.create_all(bind=engine)
+app = FastAPI()
 
 
-app = FastAPI()
+@app.on_event("startup")
+async def check_schema():
+    if settings.schema_check:
+        await migrations.check_schema()
 
 
 origins = [
@@ -22,7 +27,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Idempotent-Replayed", "Retry-After"],
 )
+app.add_middleware(MetricsMiddleware)
+
+if settings.sql_debug:
+    # development only: traces every statement of every request
+    sqltrace.instrument_engine(async_engine.sync_engine)
+    app.add_middleware(sqltrace.SQLTraceMiddleware)
+    app.include_router(sqltrace.router)
 
 
 app.include_router(order.router)
@@ -30,6 +43,10 @@ app.include_router(auth.router)
 app.include_router(admin.router)
 app.include_router(user.router)
 app.include_router(product.router)
+app.include_router(export.router)
+
+
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
 
 
 @ app.get("/")
@@ -0,0 +1,144 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Match
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request, until the response has been sent',
+    ['method', 'route', 'status'])
+REQUESTS_IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'Requests being handled right now')
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'SQL statements executed per request', ['method', 'route'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, float('inf')))
+REQUEST_DB_TIME = Histogram(
+    'http_request_db_seconds', 'Time spent in SQL statements per request', ['method', 'route'])
+QUERY_LATENCY = Histogram(
+    'db_query_duration_seconds', 'SQL statement execution time', ['engine'])
+QUERY_ERRORS = Counter(
+    'db_query_errors', 'SQL statements that raised', ['engine'])
+POOL_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection', ['engine'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, float('inf')))
+POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out', 'Connections currently checked out of the pool', ['engine'])
+POOL_SIZE = Gauge(
+    'db_pool_size', 'Connections the pool keeps open, not counting overflow', ['engine'])
+POOL_OVERFLOW = Gauge(
+    'db_pool_overflow', 'Connections open beyond the pool size', ['engine'])
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# set by the middleware; the engine events add to whatever request is running the statement
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+class _TimedCheckout:
+    # times QueuePool._do_get, which is where a checkout blocks when the pool is exhausted
+    metrics_label = 'default'
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.labels(self.metrics_label).observe(time.perf_counter() - start)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument_pool(engine, label: str):
+    # run again after engine.dispose(), which swaps in a new, unlabelled pool; the gauges
+    # look the pool up when scraped so they never read a discarded one
+    if isinstance(engine.pool, _TimedCheckout):
+        engine.pool.metrics_label = label
+    if hasattr(engine.pool, 'checkedout'):
+        POOL_CHECKED_OUT.labels(label).set_function(lambda: engine.pool.checkedout())
+        POOL_SIZE.labels(label).set_function(lambda: engine.pool.size())
+        POOL_OVERFLOW.labels(label).set_function(lambda: max(engine.pool.overflow(), 0))
+
+
+def instrument_engine(engine, label: str):
+    # engine is a sync Engine; pass AsyncEngine.sync_engine for the async one
+    instrument_pool(engine, label)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+        QUERY_LATENCY.labels(label).observe(elapsed)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        QUERY_ERRORS.labels(label).inc()
+
+
+def route_template(app, scope) -> str:
+    # the route template rather than the raw path, so /products/1 and /products/2 share a series
+    for route in app.router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    # plain ASGI middleware: BaseHTTPMiddleware would buffer streamed responses
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+        stats = RequestStats()
+        token = request_stats.set(stats)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_PROGRESS.dec()
+            request_stats.reset(token)
+            method, route = scope['method'], route_template(scope['app'], scope)
+            REQUEST_LATENCY.labels(method, route, status_code).observe(elapsed)
+            REQUEST_QUERIES.labels(method, route).observe(stats.queries)
+            REQUEST_DB_TIME.labels(method, route).observe(stats.db_seconds)
+
+
+async def metrics_endpoint(request: Request):
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,55 @@
+import logging
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def alembic_config():
+    # alembic is imported on first use, it isn't needed to serve requests
+    from alembic.config import Config
+
+    config = Config(str(ROOT / 'alembic.ini'))
+    config.set_main_option('script_location', str(ROOT / 'alembic'))
+    return config
+
+
+class SchemaOutdated(RuntimeError):
+    pass
+
+
+async def check_schema():
+    # one query per worker instead of reflecting every table; the schema itself is managed
+    # by Alembic (python -m tools.migrate), never by the app
+    from alembic.script import ScriptDirectory
+    from alembic.util import CommandError
+
+    script = ScriptDirectory.from_config(alembic_config())
+    heads = set(script.get_heads())
+    try:
+        async with database.async_engine.connect() as conn:
+            current = set((await conn.execute(text("SELECT version_num FROM alembic_version"))).scalars())
+    except ProgrammingError:
+        current = set()
+    if current == heads:
+        return
+
+    unknown = []
+    for revision in current:
+        try:
+            script.get_revision(revision)
+        except CommandError:
+            unknown.append(revision)
+    if unknown:
+        # migrated by a newer release, e.g. during a rolling deploy; this code still works against it
+        logger.warning("database schema is at %s, which this release doesn't know (head %s)",
+                       ', '.join(sorted(current)), ', '.join(sorted(heads)))
+        return
+    raise SchemaOutdated(f"database schema is at {', '.join(sorted(current)) or 'no revision'}, expected "
+                         f"{', '.join(sorted(heads))}: run `python -m tools.migrate` first")
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, text, ForeignKey
-from sqlalchemy.dialects.postgresql import TIMESTAMP
-from sqlalchemy.orm import relationship
+from sqlalchemy import CheckConstraint, Column, Computed, DDL, Integer, String, Float, DateTime, Text, event, text, ForeignKey, ForeignKeyConstraint, Index
+from sqlalchemy.dialects.postgresql import TIMESTAMP, TSVECTOR
+from sqlalchemy.orm import deferred, relationship
 from .database import Base
 
 
@@ -8,7 +8,7 @@ class Admin(Base):
     __tablename__ = 'admins'
 
     id = Column(Integer, primary_key=True)
-    username = Column(String(255), nullable=False)
+    username = Column(String(255), nullable=False, unique=True, index=True)
     password = Column(String(1024), nullable=False)
     created_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
@@ -21,7 +21,7 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
-    email = Column(String(255), nullable=False)
+    email = Column(String(255), nullable=False, unique=True, index=True)
     phone = Column(String(255), nullable=False)
     password = Column(String(1024), nullable=False)
     address = Column(String(1024), nullable=False)
@@ -32,6 +32,9 @@ class User(Base):
     orders = relationship('Order', back_populates='user')
     payments = relationship('Payment', back_populates='user')
     reviews = relationship('Review', back_populates='user')
+    # moved out of orders and payments by tools.maintenance archive
+    archived_orders = relationship('ArchivedOrder', viewonly=True)
+    archived_payments = relationship('ArchivedPayment', viewonly=True)
 
 
 class Product(Base):
@@ -46,9 +49,33 @@ class Product(Base):
                         nullable=False, server_default=text('now()'))
     updated_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
+    # kept up to date by the review endpoints
+    rating_avg = Column(Float, nullable=False, server_default=text('0'))
+    rating_count = Column(Integer, nullable=False, server_default=text('0'))
+    # units on hand, NULL when the product isn't stock-tracked; only changed by app/inventory.py
+    # and admin edits, so checkouts never read-modify-write it
+    stock = Column(Integer, CheckConstraint('stock >= 0', name='ck_products_stock'))
+    # maintained by postgres on every insert/update, only used for filtering
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', name), 'A') || setweight(to_tsvector('english', description), 'B')", persisted=True)))
 
     reviews = relationship('Review', back_populates='product')
 
+    # keyset pagination orders by (sort key, id)
+    __table_args__ = (
+        Index('ix_products_created_at_id', 'created_at', 'id'),
+        Index('ix_products_price_id', 'price', 'id'),
+        Index('ix_products_rating_avg_id', 'rating_avg', 'id'),
+        Index('ix_products_search_vector', 'search_vector',
+              postgresql_using='gin'),
+        Index('ix_products_name_trgm', 'name', postgresql_using='gin',
+              postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
+
+
+event.listen(Product.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
 
 class Review(Base):
     __tablename__ = 'reviews'
@@ -57,7 +84,7 @@ class Review(Base):
     product_id = Column(Integer, ForeignKey(
         'products.id', ondelete='CASCADE'), primary_key=True)
     user_id = Column(Integer, ForeignKey(
-        'users.id', ondelete='CASCADE'), primary_key=True)
+        'users.id', ondelete='CASCADE'), primary_key=True, index=True)
     comment = Column(String(1024), nullable=False)
     rating = Column(Float, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True),
@@ -72,10 +99,12 @@ class Review(Base):
 class Order(Base):
     __tablename__ = 'orders'
 
-    id = Column(Integer, primary_key=True)
+    # range partitioned by order_date (tools.maintenance adds the monthly partitions), so the
+    # primary key has to include it; ids still come from one sequence
+    id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey(
         'users.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
-    order_date = Column(TIMESTAMP(timezone=True), nullable=False)
+    order_date = Column(TIMESTAMP(timezone=True), primary_key=True)
     total_price = Column(Float, nullable=False)
     shipping_address = Column(String(1024), nullable=False)
     status = Column(String(32), default='pending', nullable=False)
@@ -87,14 +116,21 @@ class Order(Base):
     items = relationship('OrderItem', back_populates='order')
     # payment = relationship('Payment')
 
+    __table_args__ = (
+        # a user's order history, newest first (scanned backwards)
+        Index('ix_orders_user_id_order_date_id', 'user_id', 'order_date', 'id'),
+        {'postgresql_partition_by': 'RANGE (order_date)'},
+    )
+
 
 class OrderItem(Base):
     __tablename__ = 'order_items'
 
-    order_id = Column(Integer, ForeignKey(
-        'orders.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    # carries its order's order_date, so items sit in the same monthly partition as the order
+    order_id = Column(Integer, primary_key=True)
+    order_date = Column(TIMESTAMP(timezone=True), primary_key=True)
     product_id = Column(Integer, ForeignKey(
-        'products.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+        'products.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True, index=True)
     quantity = Column(Integer, nullable=False)
     price = Column(Float, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True),
@@ -104,14 +140,20 @@ class OrderItem(Base):
     order = relationship('Order', back_populates='items')
     product = relationship('Product')
 
+    __table_args__ = (
+        ForeignKeyConstraint(['order_id', 'order_date'], ['orders.id', 'orders.order_date'],
+                             ondelete='CASCADE', onupdate='CASCADE'),
+        {'postgresql_partition_by': 'RANGE (order_date)'},
+    )
+
 
 class Payment(Base):
     __tablename__ = 'payments'
 
     user_id = Column(Integer, ForeignKey(
         'users.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
-    order_id = Column(Integer, ForeignKey(
-        'orders.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    order_id = Column(Integer, primary_key=True, index=True)
+    order_date = Column(TIMESTAMP(timezone=True), primary_key=True)
     payment_date = Column(TIMESTAMP(timezone=True), nullable=False)
     amount = Column(Float, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True),
@@ -120,3 +162,119 @@ class Payment(Base):
                         nullable=False, server_default=text('now()'))
     user = relationship('User', back_populates='payments')
     # order = relationship('Order', back_populates='payment')
+
+    __table_args__ = (
+        ForeignKeyConstraint(['order_id', 'order_date'], ['orders.id', 'orders.order_date'],
+                             ondelete='CASCADE', onupdate='CASCADE'),
+        {'postgresql_partition_by': 'RANGE (order_date)'},
+    )
+
+
+# closed orders moved out of the live tables by `python -m tools.maintenance archive`;
+# yearly partitions, only read when an order isn't found in the live ones
+class ArchivedOrder(Base):
+    __tablename__ = 'orders_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey(
+        'users.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
+    order_date = Column(TIMESTAMP(timezone=True), primary_key=True)
+    total_price = Column(Float, nullable=False)
+    shipping_address = Column(String(1024), nullable=False)
+    status = Column(String(32), nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    items = relationship('ArchivedOrderItem')
+
+    __table_args__ = (
+        # the order history pages through it with the same key as orders
+        Index('ix_orders_archive_user_id_order_date_id', 'user_id', 'order_date', 'id'),
+        {'postgresql_partition_by': 'RANGE (order_date)'},
+    )
+
+
+class ArchivedOrderItem(Base):
+    __tablename__ = 'order_items_archive'
+
+    order_id = Column(Integer, primary_key=True)
+    order_date = Column(TIMESTAMP(timezone=True), primary_key=True)
+    product_id = Column(Integer, ForeignKey(
+        'products.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True, index=True)
+    quantity = Column(Integer, nullable=False)
+    price = Column(Float, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(['order_id', 'order_date'], ['orders_archive.id', 'orders_archive.order_date'],
+                             ondelete='CASCADE', onupdate='CASCADE'),
+        {'postgresql_partition_by': 'RANGE (order_date)'},
+    )
+
+
+class ArchivedPayment(Base):
+    __tablename__ = 'payments_archive'
+
+    user_id = Column(Integer, ForeignKey(
+        'users.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    order_id = Column(Integer, primary_key=True)
+    order_date = Column(TIMESTAMP(timezone=True), primary_key=True)
+    payment_date = Column(TIMESTAMP(timezone=True), nullable=False)
+    amount = Column(Float, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(['order_id', 'order_date'], ['orders_archive.id', 'orders_archive.order_date'],
+                             ondelete='CASCADE', onupdate='CASCADE'),
+        {'postgresql_partition_by': 'RANGE (order_date)'},
+    )
+
+
+class OrderDate(Base):
+    # every order's partition key by id, filled by a trigger on orders (see below); a lookup by
+    # id alone reads it to touch only that order's partition, live or archived
+    __tablename__ = 'order_dates'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    order_date = Column(TIMESTAMP(timezone=True), nullable=False)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_keys'
+
+    # keys are per user, so one client can't replay another's response
+    user_id = Column(Integer, ForeignKey(
+        'users.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    # set in the same transaction as the work the key guards
+    status_code = Column(Integer)
+    response = Column(Text)
+    created_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text('now()'), index=True)
+
+
+# a partitioned table takes no rows until it has a partition; the default one catches any
+# order_date the dated partitions don't cover yet
+for _table in (Order.__table__, OrderItem.__table__, Payment.__table__,
+               ArchivedOrder.__table__, ArchivedOrderItem.__table__, ArchivedPayment.__table__):
+    event.listen(_table, 'after_create', DDL(
+        'CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT'))
+
+# an order keeps its id and date when it's archived or moved between partitions, so an id
+# that is already recorded is skipped
+RECORD_ORDER_DATES = '''
+CREATE OR REPLACE FUNCTION record_order_dates() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO order_dates (id, order_date) SELECT id, order_date FROM inserted ON CONFLICT (id) DO NOTHING;
+    RETURN NULL;
+END
+$$
+'''
+ORDER_DATES_TRIGGER = '''
+CREATE TRIGGER orders_record_order_dates AFTER INSERT ON orders
+REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE FUNCTION record_order_dates()
+'''
+event.listen(Order.__table__, 'after_create', DDL(RECORD_ORDER_DATES))
+event.listen(Order.__table__, 'after_create', DDL(ORDER_DATES_TRIGGER))
@@ -1,10 +1,12 @@
 from fastapi import Depends, status, HTTPException
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.security import OAuth2PasswordBearer
 
 from . import schemas, database, models
+from .cache import TTLCache
 from .config import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
@@ -14,6 +16,10 @@ SECRET_KEY = settings.secret_key
 ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
+# (role, id) -> schemas.Principal, so authenticated routes skip the user lookup
+_principals = TTLCache(maxsize=settings.principal_cache_size,
+                       ttl=settings.principal_cache_ttl)
+
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -41,19 +47,29 @@ def verify_access_token(token: str, credentials_exception, role: str):
     return token_data
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+async def _get_principal(token: str, role: str, db: AsyncSession):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                           detail=f"Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
-    token = verify_access_token(token, credentials_exception, 'client')
-    user = db.query(models.User).filter_by(id=token.id).first()
+    token = verify_access_token(token, credentials_exception, role)
+    key = (role, int(token.id))
+    principal = _principals.get(key)
+    if principal is None:
+        model = models.Admin if role == 'admin' else models.User
+        if not await db.scalar(select(model.id).filter_by(id=key[1])):
+            raise credentials_exception
+        principal = schemas.Principal(id=key[1], role=role)
+        _principals.set(key, principal)
 
-    return user
+    return principal
 
 
-def get_current_admin(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
-    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                          detail=f"Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
-    token = verify_access_token(token, credentials_exception, 'admin')
-    admin = db.query(models.Admin).filter_by(id=token.id).first()
+def invalidate_principal(role: str, id: int):
+    _principals.delete((role, id))
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
+    return await _get_principal(token, 'client', db)
+
 
-    return admin
+async def get_current_admin(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
+    return await _get_principal(token, 'admin', db)
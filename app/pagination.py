@@ -0,0 +1,32 @@
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException, status
+from sqlalchemy import DateTime, tuple_
+
+
+def encode_cursor(tag: str, values) -> str:
+    payload = json.dumps([tag, *values], default=lambda v: v.isoformat())
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, tag: str, columns) -> list:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(payload, list) or payload[:1] != [tag] or len(payload) != len(columns) + 1:
+            raise ValueError(cursor)
+        return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                for column, value in zip(columns, payload[1:])]
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def keyset(query, columns, descending: bool = False, after=None):
+    # order by the full key so rows with equal sort values keep a stable order
+    if after is not None:
+        key = tuple_(*columns)
+        query = query.filter(key < tuple(after) if descending else key > tuple(after))
+    return query.order_by(*(column.desc() if descending else column for column in columns))
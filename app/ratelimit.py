@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+
+from .config import settings
+
+# (key, burst capacity, tokens refilled per second)
+Bucket = Tuple[str, float, float]
+
+
+class MemoryBuckets:
+    # per-process; with several workers each one allows the full rate
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    async def take(self, buckets: List[Bucket]) -> float:
+        now = time.monotonic()
+        levels = []
+        for key, capacity, rate in buckets:
+            tokens, at = self._buckets.get(key, (capacity, now))
+            levels.append(min(capacity, tokens + (now - at) * rate))
+        wait = max(((1 - tokens) / rate for tokens, (_, _, rate) in zip(levels, buckets) if tokens < 1), default=0.0)
+        for tokens, (key, _, _) in zip(levels, buckets):
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# all buckets or none, in one round trip; the refill clock is the redis server's
+_TAKE = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local levels, wait = {}, 0
+for i, key in ipairs(KEYS) do
+    local capacity, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'at')
+    local tokens = tonumber(state[1]) or capacity
+    tokens = math.min(capacity, tokens + math.max(0, now - (tonumber(state[2]) or now)) * rate)
+    if tokens < 1 then wait = math.max(wait, (1 - tokens) / rate) end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local capacity, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', tostring(wait > 0 and levels[i] or levels[i] - 1), 'at', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate))
+end
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    # shared by every worker pointed at the same redis
+    def __init__(self, namespace: str, url: str):
+        import redis.asyncio
+
+        self.namespace = namespace
+        self._take = redis.asyncio.from_url(url).register_script(_TAKE)
+
+    async def take(self, buckets: List[Bucket]) -> float:
+        args = [value for _, capacity, rate in buckets for value in (capacity, rate)]
+        return float(await self._take(keys=[f"{self.namespace}:{key}" for key, _, _ in buckets], args=args))
+
+
+def create_buckets(namespace: str, maxsize: int):
+    if settings.cache_backend == 'redis':
+        return RedisBuckets(namespace, settings.cache_url)
+    return MemoryBuckets(maxsize)
@@ -1,11 +1,14 @@
 
 from fastapi import APIRouter, Response, status, HTTPException, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from datetime import datetime
 
 
-from .. import schemas, models, utils, database
+from .. import schemas, models, utils, database, oauth2
+from ..config import settings
 
 router = APIRouter(
     prefix="/admins",
@@ -14,29 +17,48 @@ router = APIRouter(
 
 
 @router.get("/", response_model=List[schemas.Admin])
-async def get_admins(db: Session = Depends(database.get_db)):
-    admins = db.query(models.Admin).all()
+async def get_admins(db: AsyncSession = Depends(database.get_read_db)):
+    admins = (await db.scalars(select(models.Admin))).all()
     return admins
 
 
 @router.post("/", response_model=schemas.Admin)
-async def create_admin(admin: schemas.CreateAdmin, db: Session = Depends(database.get_db)):
-    db_admin = db.query(models.Admin).filter(
-        models.Admin.username == admin.username).first()
+async def create_admin(admin: schemas.CreateAdmin, db: AsyncSession = Depends(database.get_async_db)):
+    db_admin = await db.scalar(select(models.Admin).filter(
+        models.Admin.username == admin.username))
     if db_admin:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
-    admin.password = utils.hash(admin.password)
+    admin.password = await utils.hash_password(admin.password)
     db_admin = models.Admin(**admin.dict())
     db.add(db_admin)
-    db.commit()
-    db.refresh(db_admin)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # a concurrent signup won the race for the unique index
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
+    await db.refresh(db_admin)
     return db_admin
 
 
+@router.get("/pool")
+async def get_pool_stats(current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    return {
+        'pgbouncer': settings.db_pgbouncer,
+        'pool_size': settings.db_pool_size,
+        'max_overflow': settings.db_max_overflow,
+        'pool_timeout': settings.db_pool_timeout,
+        'pool_recycle': settings.db_pool_recycle,
+        'pool_pre_ping': settings.db_pool_pre_ping,
+        'engines': database.pool_stats(),
+    }
+
+
 @router.get("/{id}", response_model=schemas.Admin)
-async def get_admin_by_id(id: int, db: Session = Depends(database.get_db)):
-    admin = db.query(models.Admin).filter(models.Admin.id == id).first()
+async def get_admin_by_id(id: int, db: AsyncSession = Depends(database.get_read_db)):
+    admin = await db.scalar(select(models.Admin).filter(models.Admin.id == id))
     if not admin:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Admin not found")
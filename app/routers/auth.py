@@ -1,37 +1,57 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import math
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import literal, literal_column, select, union_all, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import database, schemas, models, utils, oauth2
+from ..config import settings
+from ..ratelimit import create_buckets
 
 
 router = APIRouter(tags=['Authentication'])
 
+login_buckets = create_buckets('login', settings.login_rate_limit_keys)
+ACCOUNTS = {'admin': models.Admin, 'client': models.User}
+
+
+async def _throttle(request: Request, username: str):
+    # runs before the database and bcrypt, so a throttled attempt costs a dict lookup (or a
+    # redis round trip). an attempt takes a token from both buckets or, when either is empty,
+    # from neither
+    wait = await login_buckets.take([
+        (f'ip:{request.client.host if request.client else ""}', settings.login_ip_burst, settings.login_ip_per_minute / 60),
+        (f'username:{username.lower()}', settings.login_username_burst, settings.login_username_per_minute / 60)])
+    if wait:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='Too many login attempts',
+                            headers={'Retry-After': str(math.ceil(wait))})
+
 
 @router.post('/login', response_model=schemas.Token)
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
-
-    admin = db.query(models.Admin).filter(
-        models.Admin.username == user_credentials.username).first()
-    if not admin:
-        user = db.query(models.User).filter(
-            models.User.email == user_credentials.username).first()
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN, detail='Invalid Credentials')
-        isValid = utils.verify(user_credentials.password, user.password)
-        if not isValid:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN, detail='Invalid Credentials')
-        access_token = oauth2.create_access_token(
-            data={'user_id': user.id, 'role': 'client'})
-    else:
-        isValid = utils.verify(user_credentials.password, admin.password)
-        if not isValid:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN, detail='Invalid Credentials')
-        access_token = oauth2.create_access_token(
-            data={'user_id': admin.id, 'role': 'admin'})
+async def login(request: Request, user_credentials: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_async_db)):
+    if settings.login_rate_limit:
+        await _throttle(request, user_credentials.username)
+
+    # admins by username and users by email in one round trip; an admin wins a name clash
+    account = (await db.execute(union_all(
+        select(literal('admin').label('role'), models.Admin.id, models.Admin.password).filter(
+            models.Admin.username == user_credentials.username),
+        select(literal('client'), models.User.id, models.User.password).filter(
+            models.User.email == user_credentials.username)).order_by(literal_column('role')).limit(1))).first()
+    if not account:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail='Invalid Credentials')
+    isValid, new_hash = await utils.verify_password(user_credentials.password, account.password)
+    if not isValid:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail='Invalid Credentials')
+    if new_hash:
+        model = ACCOUNTS[account.role]
+        await db.execute(update(model).filter(model.id == account.id).values(password=new_hash))
+        await db.commit()
+    access_token = oauth2.create_access_token(
+        data={'user_id': account.id, 'role': account.role})
 
     return {
         'access_token': access_token,
@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, union_all
+
+from .. import schemas, models, database, oauth2
+from ..config import settings
+
+router = APIRouter(
+    prefix="/export",
+    tags=['Export']
+)
+
+PRODUCT_FIELDS = ['id', 'name', 'description', 'price', 'image_url', 'stock',
+                  'rating_avg', 'rating_count', 'created_at', 'updated_at']
+REVIEW_FIELDS = ['product_id', 'user_id', 'comment',
+                 'rating', 'created_at', 'updated_at']
+ORDER_FIELDS = ['id', 'user_id', 'order_date', 'total_price',
+                'shipping_address', 'status', 'created_at', 'updated_at']
+ORDER_ITEM_FIELDS = ['product_id', 'quantity', 'price']
+
+MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _ndjson(rows, fields) -> str:
+    return ''.join(json.dumps({field: _value(value) for field, value in zip(fields, row)}) + '\n' for row in rows)
+
+
+def _csv(rows) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_value(value) for value in row] for row in rows)
+    return buffer.getvalue()
+
+
+async def _flat(partitions, fields, format: str):
+    if format == 'csv':
+        yield _csv([fields])
+    async for rows in partitions:
+        yield _csv(rows) if format == 'csv' else _ndjson(rows, fields)
+
+
+async def _orders(partitions, format: str):
+    # rows come ordered by order id, one per item; ndjson folds them back into one line per order
+    if format == 'csv':
+        async for chunk in _flat(partitions, ORDER_FIELDS + [f'item_{field}' for field in ORDER_ITEM_FIELDS], format):
+            yield chunk
+        return
+    order = None
+    async for rows in partitions:
+        lines = []
+        for row in rows:
+            if order is None or order['id'] != row[0]:
+                if order is not None:
+                    lines.append(json.dumps(order) + '\n')
+                order = {field: _value(value) for field, value in zip(ORDER_FIELDS, row)}
+                order['items'] = []
+            item = row[len(ORDER_FIELDS):]
+            if item[0] is not None:
+                order['items'].append(dict(zip(ORDER_ITEM_FIELDS, item)))
+        yield ''.join(lines)
+    if order is not None:
+        yield json.dumps(order) + '\n'
+
+
+async def _stream(query, render, *args):
+    # runs after the endpoint has returned, so it holds its own (replica) connection for the whole
+    # export; yield_per makes asyncpg fetch through a server-side cursor one batch at a time
+    conn = await database.connect_read()
+    try:
+        result = await conn.stream(query.execution_options(yield_per=settings.export_batch_size))
+        async for chunk in render(result.partitions(), *args):
+            if chunk:
+                yield chunk
+    finally:
+        await conn.close()
+
+
+def _response(name: str, format: str, chunks) -> StreamingResponse:
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[format], headers={
+        'Content-Disposition': f'attachment; filename="{name}.{format}"'})
+
+
+@router.get('/products')
+async def export_products(format: str = Query('ndjson', regex='^(ndjson|csv)$'), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    query = select(*(getattr(models.Product, field) for field in PRODUCT_FIELDS)).order_by(models.Product.id)
+    return _response('products', format, _stream(query, _flat, PRODUCT_FIELDS, format))
+
+
+@router.get('/reviews')
+async def export_reviews(format: str = Query('ndjson', regex='^(ndjson|csv)$'), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    query = select(*(getattr(models.Review, field) for field in REVIEW_FIELDS)).order_by(
+        models.Review.product_id, models.Review.user_id)
+    return _response('reviews', format, _stream(query, _flat, REVIEW_FIELDS, format))
+
+
+@router.get('/orders')
+async def export_orders(format: str = Query('ndjson', regex='^(ndjson|csv)$'), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    # live and archived orders, merged back into one id order
+    query = union_all(*(select(*(getattr(order, field) for field in ORDER_FIELDS),
+                               *(getattr(item, field) for field in ORDER_ITEM_FIELDS)).outerjoin(order.items)
+                        for order, item in ((models.Order, models.OrderItem), (models.ArchivedOrder, models.ArchivedOrderItem))))
+    query = query.order_by(query.selected_columns.id, query.selected_columns.product_id)
+    return _response('orders', format, _stream(query, _orders, format))
@@ -1,10 +1,16 @@
-from fastapi import APIRouter, FastAPI, Response, status, HTTPException, Depends
-from sqlalchemy import and_, or_
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, FastAPI, Header, Request, Response, status, HTTPException, Depends
+from sqlalchemy import Integer, and_, bindparam, cast, func, or_, select, text, update
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
 
-from .. import schemas, models, database, oauth2
+from .. import schemas, models, database, oauth2, idempotency, inventory
+from ..config import settings
+from ..conditional import not_modified, validators
+from .product import invalidate_stock
 
 router = APIRouter(
     prefix="/orders",
@@ -12,75 +18,219 @@ router = APIRouter(
 )
 
 
+# status -> statuses it may move to; arrived and cancelled are final
+ORDER_TRANSITIONS = {
+    'pending': ('in_delivery', 'cancelled'),
+    'in_delivery': ('arrived', 'cancelled'),
+}
+
+
+def _order_date(id: int):
+    # the order's partition key, so a lookup by id touches one partition instead of every month
+    return select(models.OrderDate.order_date).filter(models.OrderDate.id == id).scalar_subquery()
+
+
+async def _get_order(db: AsyncSession, id: int, model=models.Order, lock: bool = False):
+    # a single order and its items in one round trip
+    query = select(model).filter(model.id == id, model.order_date == _order_date(id)).options(joinedload(model.items))
+    if lock:
+        query = query.with_for_update(of=model)
+    result = await db.execute(query)
+    return result.unique().scalar_one_or_none()
+
+
+async def _reserve(db: AsyncSession, quantities: dict) -> List[int]:
+    # a flash sale funnels every checkout through the same product row; past the timeout the
+    # client is told to retry instead of tying up a pool connection in the lock queue
+    await db.execute(text(f"SET LOCAL lock_timeout = {int(settings.stock_lock_timeout_ms)}"))
+    try:
+        reserved, shortfall = await inventory.reserve(db, quantities)
+    except DBAPIError as e:
+        if getattr(e.orig, 'sqlstate', None) != '55P03':
+            raise
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many concurrent orders for these products, try again", headers={'Retry-After': '1'})
+    if shortfall:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Not enough stock: " + ', '.join(
+            f"product {item['product_id']} has {item['available']} left" for item in shortfall))
+    return reserved
+
+
 @ router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.Order)
-async def create_order(order: schemas.CreateOrder, db: Session = Depends(database.get_db), current_user: schemas.User = Depends(oauth2.get_current_user)):
+async def create_order(order: schemas.CreateOrder, request: Request, db: AsyncSession = Depends(database.get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_user),
+                       idempotency_key: Optional[str] = Header(None, min_length=1, max_length=255)):
+    if idempotency_key is not None:
+        replay = await idempotency.claim(db, current_user.id, idempotency_key,
+                                         idempotency.fingerprint(request, order.json(sort_keys=True)))
+        if replay is not None:
+            return replay
+
+    quantities, reserved = {}, []
+    for item in order.order_items:
+        quantities[item.product_id] = quantities.get(
+            item.product_id, 0) + item.quantity
+
+    prices = dict((await db.execute(select(models.Product.id, models.Product.price).filter(
+        models.Product.id.in_(quantities)))).all())
+    missing = sorted(set(quantities) - set(prices))
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Product not found: {missing}")
+    for item in order.order_items:
+        if item.price is not None and item.price != prices[item.product_id]:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=f"Price of product {item.product_id} has changed")
+    total_price = sum(prices[product_id] * quantity
+                      for product_id, quantity in quantities.items())
+    if order.total_price is not None and abs(order.total_price - total_price) > 0.005:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Total price does not match the order items ({total_price})")
+
     try:
-        new_order = models.Order(user_id=current_user.id, order_date=order.order_date,
-                                 total_price=order.total_price, shipping_address=order.shipping_address, status=order.status)
+        # the items go out as one multi-row INSERT ... RETURNING on flush
+        # the partition key, so it's the server's clock: a client's date could land far outside
+        # the partitions that exist
+        new_order = models.Order(user_id=current_user.id, order_date=datetime.now(timezone.utc),
+                                 total_price=total_price, shipping_address=order.shipping_address, status=order.status,
+                                 items=[models.OrderItem(product_id=product_id, quantity=quantity, price=prices[product_id])
+                                        for product_id, quantity in quantities.items()])
         db.add(new_order)
-        db.commit()
-        db.refresh(new_order)
-        items_to_commit = []
-        for item in order.order_items:
-            order_item: schemas.CreateOrderItem = item
-            db_product = db.query(models.Product).get(order_item.product_id)
-            if not db_product:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST, detail="Product not found")
-            order_item = models.OrderItem(
-                order_id=new_order.id,
-                **order_item.dict()
-            )
-            items_to_commit.append(order_item)
-        db.add_all(items_to_commit)
-        db.commit()
-
         if order.payment:
-            payment = models.Payment(
+            await db.flush()
+            db.add(models.Payment(
                 order_id=new_order.id,
+                order_date=new_order.order_date,
                 user_id=current_user.id,
                 **order.payment.dict()
-            )
-            db.add(payment)
-            db.commit()
-            db.refresh(payment)
-    except:
-        db.rollback()
+            ))
+        if idempotency_key is not None:
+            await db.flush()
+            await idempotency.save(db, current_user.id, idempotency_key, status.HTTP_201_CREATED,
+                                   schemas.Order.from_orm(new_order).json())
+        if order.status != 'cancelled':
+            # last, so the product row locks are only held for the commit
+            await db.flush()
+            reserved = await _reserve(db, quantities)
+        await db.commit()
+    except SQLAlchemyError:
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred")
+    # stock is part of the product body, and the sale moved its updated_at
+    if reserved:
+        await invalidate_stock(reserved)
     return new_order
 
 
+@router.post('/status', response_model=schemas.BulkOrderStatusResult)
+async def update_orders_status(update_data: schemas.BulkUpdateOrderStatus, db: AsyncSession = Depends(database.get_async_db), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    sources = [source for source, targets in ORDER_TRANSITIONS.items()
+               if update_data.status in targets]
+    if not sources or (update_data.current_status and update_data.current_status not in sources):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Orders can't move to {update_data.status}" + (
+                                f" from {update_data.current_status}" if update_data.current_status else ""))
+
+    # plain table statements, the ORM doesn't accept an UPDATE nested in a CTE
+    orders = models.Order.__table__
+    conditions = [orders.c.status.in_(sources)]
+    if update_data.current_status:
+        conditions.append(orders.c.status == update_data.current_status)
+    if update_data.ordered_before:
+        conditions.append(orders.c.order_date < update_data.ordered_before)
+    query = update(orders).values(status=update_data.status, updated_at=func.now())
+
+    if update_data.ids is None:
+        updated = (await db.execute(query.filter(*conditions).returning(orders.c.id))).scalars().all()
+        restocked = await inventory.restock(db, updated) if update_data.status == 'cancelled' and updated else []
+        await db.commit()
+        if restocked:
+            await invalidate_stock(restocked)
+        return {'updated': sorted(updated)}
+
+    # one statement: the UPDATE runs as a CTE and the outer select sees each id's prior status,
+    # which tells apart updated, rejected (transition not allowed) and missing ids
+    requested = select(func.unnest(cast(bindparam('ids'), ARRAY(Integer))).label('id')).cte('requested')
+    changed = query.filter(orders.c.id == requested.c.id, *conditions).returning(
+        orders.c.id).cte('changed')
+    rows = (await db.execute(select(requested.c.id, orders.c.status, changed.c.id.is_not(None)).select_from(
+        requested.outerjoin(orders, orders.c.id == requested.c.id).outerjoin(
+            changed, changed.c.id == requested.c.id)).order_by(requested.c.id),
+        {'ids': list(dict.fromkeys(update_data.ids))})).all()
+    restocked = []
+    if update_data.status == 'cancelled':
+        cancelled = [id for id, _, updated in rows if updated]
+        if cancelled:
+            restocked = await inventory.restock(db, cancelled)
+    await db.commit()
+    if restocked:
+        await invalidate_stock(restocked)
+    return {
+        'updated': [id for id, _, updated in rows if updated],
+        'rejected': [{'id': id, 'status': current} for id, current, updated in rows if current and not updated],
+        'missing': [id for id, current, _ in rows if current is None],
+    }
+
+
 @router.get('/{id}', response_model=schemas.Order)
-async def get_order_by_id(id: int, db: Session = Depends(database.get_db)):
-    order = db.query(models.Order).filter(models.Order.id == id).first()
+async def get_order_by_id(id: int, request: Request, response: Response, db: AsyncSession = Depends(database.get_read_db)):
+    # items can't change after checkout, so the order's updated_at versions the whole body
+    model = models.Order
+    updated_at = await db.scalar(select(model.updated_at).filter(model.id == id, model.order_date == _order_date(id)))
+    if updated_at is None:
+        # closed orders past the archive cutoff have moved out of the live partitions
+        model = models.ArchivedOrder
+        updated_at = await db.scalar(select(model.updated_at).filter(model.id == id, model.order_date == _order_date(id)))
+    if updated_at is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Order with id: {id} was not found')
+    unchanged = not_modified(request, validators('order', id, updated_at))
+    if unchanged:
+        return unchanged
+
+    order = await _get_order(db, id, model)
     if not order:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Order with id: {id} was not found')
+    response.headers.update(validators('order', id, order.updated_at))
     return order
 
 
 @router.put('/{id}', response_model=schemas.Order)
-async def update_order(id: int, update_data: schemas.UpdateOrder, db: Session = Depends(database.get_db), current_admin: schemas.Admin = Depends(oauth2.get_current_admin)):
-    order = db.query(models.Order).filter_by(id=id).first()
+async def update_order(id: int, update_data: schemas.UpdateOrder, db: AsyncSession = Depends(database.get_async_db), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    # locked, so two cancellations of the same order can't both restock it
+    order = await _get_order(db, id, lock=True)
     if not order:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Order with id: {id} was not found')
 
+    previous = order.status
     for key, value in update_data.dict().items():
         if value is not None:
             setattr(order, key, value)
     order.updated_at = datetime.now()
-    db.commit()
-    db.refresh(order)
+    await db.flush()
+    changed = []
+    if previous != 'cancelled' and order.status == 'cancelled':
+        changed = await inventory.restock(db, [id])
+    elif previous == 'cancelled' and order.status != 'cancelled':
+        changed = await _reserve(db, {item.product_id: item.quantity for item in order.items})
+    await db.commit()
+    if changed:
+        await invalidate_stock(changed)
 
     return order
 
 
 @router.get('/payments/{order_id}', response_model=schemas.Payment)
-def get_user_payment_by_order_id(order_id: int, db: Session = Depends(database.get_db), current_user: schemas.User = Depends(oauth2.get_current_user)):
-    db_payment = db.query(models.Payment).filter(and_(
-        models.Payment.user_id == current_user.id, models.Payment.order_id == order_id)).first()
+async def get_user_payment_by_order_id(order_id: int, db: AsyncSession = Depends(database.get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+    for model in (models.Payment, models.ArchivedPayment):
+        db_payment = await db.scalar(select(model).filter(and_(
+            model.user_id == current_user.id, model.order_id == order_id, model.order_date == _order_date(order_id))))
+        if db_payment:
+            break
     if not db_payment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Payment was not found')
@@ -100,7 +250,7 @@ def get_user_payment_by_order_id(order_id: int, db: Session = Depends(database.g
 
 # @router.post("/{order_id}/orderitems", response_model=schemas.OrderItem)
 # async def create_order_item(
-#     order_id: int,  order_item: schemas.CreateOrderItem, db: Session = Depends(database.get_db), current_user: schemas.User = Depends(oauth2.get_current_user)
+#     order_id: int,  order_item: schemas.CreateOrderItem, db: Session = Depends(database.get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)
 # ):
 #     db_order = db.query(models.Order).get(order_id)
 #     if not db_order:
@@ -1,61 +1,213 @@
-from fastapi import APIRouter, FastAPI, Response, status, HTTPException, Depends
-from sqlalchemy import and_, func, or_
-from sqlalchemy.orm import Session
+import io
+
+from fastapi import APIRouter, FastAPI, Query, Request, Response, UploadFile, status, HTTPException, Depends
+from sqlalchemy import and_, case, delete, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from typing import List, Optional
 from datetime import datetime
 
-from .. import schemas, models, database, oauth2
+from .. import schemas, models, database, oauth2, importer
+from ..conditional import not_modified, validators
+from ..cache import create_backend
+from ..config import settings
+from ..expand import expand_options
+from ..pagination import decode_cursor, encode_cursor, keyset
 
 router = APIRouter(
     prefix="/products",
     tags=['Products']
 )
 
+# sort name -> (keyset columns, descending); every key ends with the primary key
+PRODUCT_SORTS = {
+    'id': ((models.Product.id,), False),
+    'newest': ((models.Product.created_at, models.Product.id), True),
+    'price_asc': ((models.Product.price, models.Product.id), False),
+    'price_desc': ((models.Product.price, models.Product.id), True),
+    'rating': ((models.Product.rating_avg, models.Product.id), True),
+}
+
+PRODUCT_EXPANSIONS = {
+    'reviews': selectinload(models.Product.reviews),
+}
+
+# serialized default responses of GET /products/{id} and the first page of GET /products/
+product_cache = create_backend(
+    'products', settings.product_cache_size, settings.product_cache_ttl)
+
+
+def _search(search: str):
+    # full-text match on name/description, plus trigram fuzzy match on the name
+    ts_query = func.websearch_to_tsquery('english', search)
+    matches = or_(models.Product.search_vector.op('@@')(ts_query),
+                  models.Product.name.op('%')(search))
+    rank = (func.ts_rank_cd(models.Product.search_vector, ts_query) +
+            func.similarity(models.Product.name, search)).label('rank')
+    return matches, rank
+
+
+def _serialize(prods) -> bytes:
+    return ('[' + ','.join(schemas.Product.from_orm(prod).json(exclude_unset=True) for prod in prods) + ']').encode()
+
+
+def _cached_page(value: bytes) -> Response:
+    # cached pages are stored as b"<next cursor>\n<json body>"
+    cursor, body = value.split(b'\n', 1)
+    response = Response(content=body, media_type='application/json')
+    if cursor:
+        response.headers['X-Next-Cursor'] = cursor.decode()
+    return response
+
+
+async def invalidate_product(id: Optional[int] = None):
+    # called after the change is committed; bumping the generation orphans every cached page
+    if id is not None:
+        await product_cache.delete(f'product:{id}')
+    await product_cache.incr('pages')
+
+
+async def invalidate_products(ids):
+    await product_cache.delete(*(f'product:{id}' for id in ids))
+    await product_cache.incr('pages')
+
+
+async def invalidate_stock(ids):
+    # stock moves with every checkout: only the products' own entries go. bumping the page
+    # generation would empty the list cache at a flash sale's peak; cached pages show the new
+    # stock once they expire (PRODUCT_CACHE_TTL)
+    await product_cache.delete(*(f'product:{id}' for id in ids))
+
 
-@ router.get('/', response_model=List[schemas.Product])
-async def get_products(db: Session = Depends(database.get_db), skip: int = 0, limit: int = 10, search: Optional[str] = ""):
-    prods = db.query(models.Product).filter(or_(models.Product.name.ilike(
-        f"%{search}%"), models.Product.description.ilike(f"%{search}%"))).offset(skip).limit(limit).all()
+async def _update_rating(db: AsyncSession, product_id: int, rating_sum, count_delta: int):
+    # rating_sum is evaluated against the row being updated, so concurrent reviews don't lose updates
+    new_count = models.Product.rating_count + count_delta
+    await db.execute(update(models.Product).filter(models.Product.id == product_id).values(
+        rating_avg=case((new_count > 0, rating_sum / new_count), else_=0),
+        rating_count=new_count, updated_at=func.now()))
 
-    # results = db.query(models.Product.id.label('id'), models.Product.name.label('name'), models.Product.description.label('description'), models.Product.image_url.label('image_url'), models.Product.price.label('price'), models.Product.created_at.label('created_at'), models.Product.updated_at.label('updated_at'), func.avg(models.Review.rating).label("rate")).join(
-    #     models.Review, models.Review.product_id == models.Product.id, isouter=True).group_by(models.Product.id).all()
-    # print(results)
+
+@ router.get('/', response_model=List[schemas.Product], response_model_exclude_unset=True)
+async def get_products(response: Response, db: AsyncSession = Depends(database.get_read_db), skip: int = 0, limit: int = 10, search: Optional[str] = "",
+                       sort: Optional[str] = Query(None, regex=f"^({'|'.join(PRODUCT_SORTS)}|relevance)$"), after: Optional[str] = None,
+                       min_rating: Optional[float] = None, expand: Optional[str] = None):
+    page_key = None
+    if skip == 0 and after is None and not search and min_rating is None and expand is None:
+        page_key = f"page:{await product_cache.counter('pages')}:{sort or 'id'}:{limit}"
+        cached = await product_cache.get(page_key)
+        if cached is not None:
+            return _cached_page(cached)
+
+    query = select(models.Product)
+    if min_rating is not None:
+        query = query.filter(models.Product.rating_avg >= min_rating)
+    if search:
+        matches, rank = _search(search)
+        query = query.filter(matches)
+
+    sort = sort or ('relevance' if search else 'id')
+    if sort == 'relevance':
+        if not search:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Sorting by relevance requires a search term")
+        columns, descending = (rank, models.Product.id), True
+    else:
+        columns, descending = PRODUCT_SORTS[sort]
+
+    query = query.add_columns(*columns)
+    if after is not None:
+        query = keyset(query, columns, descending,
+                       decode_cursor(after, sort, columns))
+    else:
+        query = keyset(query, columns, descending).offset(skip)
+    rows = (await db.execute(query.limit(limit).options(
+        *expand_options(expand, PRODUCT_EXPANSIONS)))).all()
+    prods = [row[0] for row in rows]
+
+    next_cursor = encode_cursor(
+        sort, rows[-1][1:]) if rows and len(rows) == limit else ''
+    if page_key is not None:
+        value = next_cursor.encode() + b'\n' + _serialize(prods)
+        await product_cache.set(page_key, value)
+        return _cached_page(value)
+
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
     return prods
 
 
-@ router.post('/', status_code=status.HTTP_201_CREATED, response_model=schemas.Product)
-async def create_product(prod: schemas.CreateProduct, db: Session = Depends(database.get_db), current_admin: schemas.Admin = Depends(oauth2.get_current_admin)):
+@ router.post('/', status_code=status.HTTP_201_CREATED, response_model=schemas.Product, response_model_exclude_unset=True)
+async def create_product(prod: schemas.CreateProduct, db: AsyncSession = Depends(database.get_async_db), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
     new_prod = models.Product(**prod.dict())
     db.add(new_prod)
-    db.commit()
-    db.refresh(new_prod)
+    await db.commit()
+    await invalidate_product()
     # print('admin id:', admin.id)
     return new_prod
 
 
-@ router.get('/{id}', response_model=schemas.Product)
-async def get_product_by_id(id: int, db: Session = Depends(database.get_db),):
-    prod = db.query(models.Product).filter(models.Product.id == id).first()
+@router.post('/import', response_model=schemas.ImportReport)
+async def import_products(file: UploadFile, format: Optional[str] = Query(None, regex='^(ndjson|csv)$'), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    format = format or ('csv' if (file.filename or '').endswith('.csv') else 'ndjson')
+    try:
+        async with database.async_engine.begin() as conn:
+            report, updated = await importer.import_products(
+                conn, importer.read_records(io.TextIOWrapper(file.file, encoding='utf-8-sig', newline=''), format))
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="The file is not UTF-8 encoded")
+    await invalidate_products(updated)
+    return report
+
+
+@ router.get('/{id}', response_model=schemas.Product, response_model_exclude_unset=True)
+async def get_product_by_id(id: int, request: Request, response: Response, db: AsyncSession = Depends(database.get_read_db), expand: Optional[str] = None):
+    options = expand_options(expand, PRODUCT_EXPANSIONS)
+    if expand is None:
+        # cached as b"<updated_at>\n<json body>" so conditional requests need no query
+        cached = await product_cache.get(f'product:{id}')
+        if cached is not None:
+            updated_at, body = cached.split(b'\n', 1)
+            headers = validators('product', id, datetime.fromisoformat(updated_at.decode()))
+            return not_modified(request, headers) or Response(content=body, media_type='application/json', headers=headers)
+
+    # review writes touch the product's updated_at too, so it also covers ?expand=reviews
+    updated_at = await db.scalar(select(models.Product.updated_at).filter(models.Product.id == id))
+    if updated_at is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Product with id: {id} was not found!')
+    unchanged = not_modified(request, validators('product', id, updated_at, expand))
+    if unchanged:
+        return unchanged
+
+    prod = await db.scalar(select(models.Product).filter(models.Product.id == id).options(*options))
     if not prod:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Product with id: {id} was not found!')
+    headers = validators('product', id, prod.updated_at, expand)
+    if expand is None:
+        body = schemas.Product.from_orm(prod).json(exclude_unset=True).encode()
+        await product_cache.set(f'product:{id}', prod.updated_at.isoformat().encode() + b'\n' + body)
+        return Response(content=body, media_type='application/json', headers=headers)
+    response.headers.update(headers)
     return prod
 
 
 @ router.delete('/{id}', status_code=status.HTTP_204_NO_CONTENT)
-async def delete_product(id: int, db: Session = Depends(database.get_db), current_admin: schemas.Admin = Depends(oauth2.get_current_admin)):
-    prod_query = db.query(models.Product).filter(models.Product.id == id)
-    if not prod_query.first():
+async def delete_product(id: int, db: AsyncSession = Depends(database.get_async_db), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    prod = await db.scalar(select(models.Product).filter(models.Product.id == id))
+    if not prod:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Product with id: {id} was not found!')
-    prod_query.delete(synchronize_session=False)
-    db.commit()
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+    await db.execute(delete(models.Product).filter(models.Product.id == id))
+    await db.commit()
+    await invalidate_product(id)
 
 
-@router.put('/{id}', response_model=schemas.Product)
-async def update_product(id: int, update_data: schemas.UpdateProduct, db: Session = Depends(database.get_db), current_admin: schemas.Admin = Depends(oauth2.get_current_admin)):
-    prod = db.query(models.Product).filter_by(id=id).first()
+@router.put('/{id}', response_model=schemas.Product, response_model_exclude_unset=True)
+async def update_product(id: int, update_data: schemas.UpdateProduct, db: AsyncSession = Depends(database.get_async_db), current_admin: schemas.Principal = Depends(oauth2.get_current_admin)):
+    prod = await db.scalar(select(models.Product).filter_by(id=id))
     if not prod:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Product with id: {id} was not found!')
@@ -64,24 +216,23 @@ async def update_product(id: int, update_data: schemas.UpdateProduct, db: Sessio
         if value is not None:
             setattr(prod, key, value)
     prod.updated_at = datetime.now()
-    db.commit()
-    db.refresh(prod)
+    await db.commit()
+    await invalidate_product(id)
 
     return prod
 
 
 @router.post("/{product_id}/reviews", response_model=schemas.Review)
 async def create_review(
-    product_id: int, review: schemas.ReviewCreate, db: Session = Depends(database.get_db),
-    current_user: schemas.User = Depends(oauth2.get_current_user)
+    product_id: int, review: schemas.ReviewCreate, db: AsyncSession = Depends(database.get_async_db),
+    current_user: schemas.Principal = Depends(oauth2.get_current_user)
 ):
-    db_product = db.query(models.Product).get(product_id)
+    db_product = await db.get(models.Product, product_id)
     if not db_product:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Product not found")
-    print(product_id, current_user.id)
-    db_review = db.query(models.Review).filter(and_(
-        models.Review.product_id == product_id, models.Review.user_id == current_user.id)).first()
+    db_review = await db.scalar(select(models.Review).filter(and_(
+        models.Review.product_id == product_id, models.Review.user_id == current_user.id)))
     # print(db_review.dict())
     if db_review:
         raise HTTPException(
@@ -92,38 +243,54 @@ async def create_review(
         **review.dict()
     )
     db.add(review)
-    db.commit()
-    db.refresh(review)
+    await _update_rating(db, product_id, models.Product.rating_avg * models.Product.rating_count + review.rating, 1)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # a concurrent request inserted the same review first; its rating update is rolled back too
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="This user has made a review before")
+    await invalidate_product(product_id)
+    await db.refresh(review)
     return review
 
 
 @router.put("/{product_id}/reviews", response_model=schemas.Review)
 async def update_review(
-    product_id: int,  review: schemas.UpdateReview, db: Session = Depends(database.get_db),
-    current_user: schemas.User = Depends(oauth2.get_current_user)
+    product_id: int,  review: schemas.UpdateReview, db: AsyncSession = Depends(database.get_async_db),
+    current_user: schemas.Principal = Depends(oauth2.get_current_user)
 ):
-    db_review = db.query(models.Review).filter(and_(
-        models.Review.product_id == product_id, models.Review.user_id == current_user.id)).first()
+    # locked, so a concurrent edit can't apply its rating delta against the same old rating
+    db_review = await db.scalar(select(models.Review).filter(and_(
+        models.Review.product_id == product_id, models.Review.user_id == current_user.id)).with_for_update())
     if not db_review:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Review not found")
 
+    if review.rating is not None and review.rating != db_review.rating:
+        await _update_rating(db, product_id, models.Product.rating_avg * models.Product.rating_count + review.rating - db_review.rating, 0)
+    else:
+        await db.execute(update(models.Product).filter(models.Product.id == product_id).values(updated_at=func.now()))
     for key, value in review.dict().items():
         if value is not None:
             setattr(db_review, key, value)
 
-    db.commit()
-    db.refresh(db_review)
+    await db.commit()
+    await invalidate_product(product_id)
+    await db.refresh(db_review)
     return db_review
 
 
 @ router.delete('/{product_id}/reviews', status_code=status.HTTP_204_NO_CONTENT)
-async def delete_review(product_id: int, db: Session = Depends(database.get_db), current_user: schemas.User = Depends(oauth2.get_current_user)):
-    review_query = db.query(models.Review).filter(and_(
-        models.Review.user_id == current_user.id, models.Review.product_id == product_id))
-    if not review_query.first():
+async def delete_review(product_id: int, db: AsyncSession = Depends(database.get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+    review_filter = and_(
+        models.Review.user_id == current_user.id, models.Review.product_id == product_id)
+    # only the request whose DELETE removed the row takes its rating out, a concurrent retry gets 404
+    rating = await db.scalar(delete(models.Review).filter(review_filter).returning(models.Review.rating))
+    if rating is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Review was not found')
-    review_query.delete(synchronize_session=False)
-    db.commit()
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+    await _update_rating(db, product_id, models.Product.rating_avg * models.Product.rating_count - rating, -1)
+    await db.commit()
+    await invalidate_product(product_id)
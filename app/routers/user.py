@@ -1,44 +1,111 @@
 
-from fastapi import APIRouter, Response, status, HTTPException, Depends
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Response, status, HTTPException, Depends, Query
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional
 from datetime import datetime
 
 
-from .. import schemas, models, utils, database
+from .. import schemas, models, utils, database, oauth2
+from ..expand import expand_options
+from ..pagination import decode_cursor, encode_cursor, keyset
 
 router = APIRouter(
     prefix="/users",
     tags=['Users']
 )
 
+USER_EXPANSIONS = {
+    'orders': (selectinload(models.User.orders).selectinload(models.Order.items),
+               selectinload(models.User.archived_orders).selectinload(models.ArchivedOrder.items)),
+    'payments': (selectinload(models.User.payments), selectinload(models.User.archived_payments)),
+    'reviews': selectinload(models.User.reviews),
+}
 
-@router.get("/", response_model=List[schemas.User])
-async def get_users(db: Session = Depends(database.get_db)):
-    users = db.query(models.User).all()
+# newest first; served by ix_orders_user_id_order_date_id (and its archive twin) whatever the length of the history
+ORDER_HISTORY_KEY = (models.Order.order_date, models.Order.id)
+
+
+async def _order_history_page(db: AsyncSession, model, user_id: int, order_status: Optional[str], ordered_after: Optional[datetime],
+                              ordered_before: Optional[datetime], after: Optional[list], limit: int) -> list:
+    query = select(model).filter(model.user_id == user_id)
+    if order_status is not None:
+        query = query.filter(model.status == order_status)
+    if ordered_after is not None:
+        query = query.filter(model.order_date >= ordered_after)
+    if ordered_before is not None:
+        query = query.filter(model.order_date < ordered_before)
+    query = keyset(query, (model.order_date, model.id), True, after)
+    # the page's items come in one IN query
+    return (await db.scalars(query.limit(limit).options(selectinload(model.items)))).all()
+
+
+async def _order_history(db: AsyncSession, response: Response, user_id: int, order_status: Optional[str], ordered_after: Optional[datetime],
+                         ordered_before: Optional[datetime], after: Optional[str], limit: int):
+    cursor = decode_cursor(after, 'orders', ORDER_HISTORY_KEY) if after is not None else None
+    # archived orders (tools.maintenance archive) are dated before the cutoff they were moved
+    # at, but open orders from before it stay live, so the two overlap: the page is merged from
+    # a page of each. ids come from one sequence, so the key is unique across both
+    orders = []
+    for model in (models.Order, models.ArchivedOrder):
+        orders += await _order_history_page(db, model, user_id, order_status, ordered_after, ordered_before, cursor, limit)
+    orders = sorted(orders, key=lambda order: (order.order_date, order.id), reverse=True)[:limit]
+    if orders and len(orders) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(
+            'orders', (orders[-1].order_date, orders[-1].id))
+    return orders
+
+
+@router.get("/", response_model=List[schemas.User], response_model_exclude_unset=True)
+async def get_users(db: AsyncSession = Depends(database.get_read_db), expand: Optional[str] = None):
+    users = (await db.scalars(select(models.User).options(*expand_options(expand, USER_EXPANSIONS)))).all()
     return users
 
 
-@router.post("/", response_model=schemas.User)
-async def create_user(user: schemas.CreateUser, db: Session = Depends(database.get_db)):
-    db_user = db.query(models.User).filter(
-        models.User.email == user.email).first()
+@router.post("/", response_model=schemas.User, response_model_exclude_unset=True)
+async def create_user(user: schemas.CreateUser, db: AsyncSession = Depends(database.get_async_db)):
+    db_user = await db.scalar(select(models.User).filter(
+        models.User.email == user.email))
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
-    user.password = utils.hash(user.password)
+    user.password = await utils.hash_password(user.password)
     db_user = models.User(**user.dict())
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # a concurrent signup won the race for the unique index
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
     return db_user
 
 
-@router.get("/{id}", response_model=schemas.User)
-async def get_user_by_id(id: int, db: Session = Depends(database.get_db)):
-    user = db.query(models.User).filter(models.User.id == id).first()
+@router.get("/me/orders", response_model=List[schemas.Order])
+async def get_my_orders(response: Response, db: AsyncSession = Depends(database.get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_user),
+                        order_status: Optional[str] = Query(None, alias='status', regex='^(arrived|in_delivery|pending|cancelled)$'), ordered_after: Optional[datetime] = None,
+                        ordered_before: Optional[datetime] = None, after: Optional[str] = None, limit: int = Query(20, ge=1, le=100)):
+    return await _order_history(db, response, current_user.id, order_status, ordered_after, ordered_before, after, limit)
+
+
+@router.get("/{id}/orders", response_model=List[schemas.Order])
+async def get_user_orders(id: int, response: Response, db: AsyncSession = Depends(database.get_read_db), current_admin: schemas.Principal = Depends(oauth2.get_current_admin),
+                          order_status: Optional[str] = Query(None, alias='status', regex='^(arrived|in_delivery|pending|cancelled)$'), ordered_after: Optional[datetime] = None,
+                          ordered_before: Optional[datetime] = None, after: Optional[str] = None, limit: int = Query(20, ge=1, le=100)):
+    orders = await _order_history(db, response, id, order_status, ordered_after, ordered_before, after, limit)
+    if not orders and not await db.scalar(select(models.User.id).filter(models.User.id == id)):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return orders
+
+
+@router.get("/{id}", response_model=schemas.User, response_model_exclude_unset=True)
+async def get_user_by_id(id: int, db: AsyncSession = Depends(database.get_read_db), expand: Optional[str] = None):
+    user = await db.scalar(select(models.User).filter(models.User.id == id).options(*expand_options(expand, USER_EXPANSIONS)))
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    print(user.orders)
     return user
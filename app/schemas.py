@@ -1,6 +1,26 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel, EmailStr, constr
+from pydantic import BaseModel, EmailStr, conint, conlist, constr, root_validator
+from pydantic.utils import GetterDict
+from sqlalchemy import inspect
+
+
+class LoadedGetterDict(GetterDict):
+    # relationships that were not eagerly loaded are left unset instead of lazy loading them
+    def get(self, key, default=None):
+        state = inspect(self._obj, raiseerr=False)
+        if state is not None and key in state.unloaded:
+            return default
+        return getattr(self._obj, key, default)
+
+
+class UserGetterDict(LoadedGetterDict):
+    # a user's archived orders and payments are listed after the live ones
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        if key in ('orders', 'payments') and isinstance(value, list):
+            value = value + super().get(f'archived_{key}', [])
+        return value
 
 
 # Payment #
@@ -25,8 +45,8 @@ class Payment(BaseModel):
 
 class CreateOrderItem(BaseModel):
     product_id: int
-    quantity: int
-    price: float
+    quantity: conint(gt=0)
+    price: Optional[float] = None
 
 
 class OrderItem(BaseModel):
@@ -42,8 +62,7 @@ class OrderItem(BaseModel):
 
 
 class CreateOrder(BaseModel):
-    order_date: str
-    total_price: float
+    total_price: Optional[float] = None
     shipping_address: str
     status: constr(
         regex='^(arrived|in_delivery|pending|cancelled)$') = "pending"
@@ -54,7 +73,7 @@ class CreateOrder(BaseModel):
 class Order(BaseModel):
     id: int
     order_date: datetime
-    total_price: float
+    total_price: Optional[float] = None
     shipping_address: str
     status: constr(regex='^(arrived|in_delivery|pending|cancelled)$')
     updated_at: datetime
@@ -71,6 +90,30 @@ class UpdateOrder(BaseModel):
     status: constr(regex='^(arrived|in_delivery|pending|cancelled)$')
 
 
+class BulkUpdateOrderStatus(UpdateOrder):
+    # either explicit ids, or every order matching the filter
+    ids: Optional[conlist(int, min_items=1, max_items=10000)] = None
+    current_status: Optional[constr(regex='^(arrived|in_delivery|pending|cancelled)$')] = None
+    ordered_before: Optional[datetime] = None
+
+    @root_validator(skip_on_failure=True)
+    def ids_or_filter(cls, values):
+        if values['ids'] is None and values['current_status'] is None and values['ordered_before'] is None:
+            raise ValueError('give ids, or current_status and/or ordered_before')
+        return values
+
+
+class RejectedOrder(BaseModel):
+    id: int
+    status: str
+
+
+class BulkOrderStatusResult(BaseModel):
+    updated: List[int]
+    rejected: List[RejectedOrder] = []
+    missing: List[int] = []
+
+
 # Reviews #
 
 
@@ -105,6 +148,11 @@ class TokenDate(BaseModel):
     id: Optional[str] = None
     role: Optional[str] = None
 
+
+class Principal(BaseModel):
+    id: int
+    role: str
+
 # Admin #
 
 
@@ -123,8 +171,8 @@ class Admin(AdminBase):
 
 class CreateAdmin(AdminBase):
     password: str
-    created_at: Optional[str] = None
-    updated_at: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
 # User #
 
@@ -141,18 +189,19 @@ class User(UserBase):
     created_at: datetime
     updated_at: datetime
 
-    orders: List[Order] = []
-    payments: List[Payment] = []
-    reviews: List[Review] = []
+    orders: Optional[List[Order]]
+    payments: Optional[List[Payment]]
+    reviews: Optional[List[Review]]
 
     class Config:
         orm_mode = True
+        getter_dict = UserGetterDict
 
 
 class CreateUser(UserBase):
     password: str
-    created_at: Optional[str] = None
-    updated_at: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
 
 class UserLogin(BaseModel):
@@ -168,30 +217,39 @@ class ProductBase(BaseModel):
     description: str
     price: float
     image_url: str
+    # null: not stock-tracked, never sells out
+    stock: Optional[conint(ge=0)] = None
 
 
 class Product(ProductBase):
     id: int
+    rating_avg: float
+    rating_count: int
     created_at: datetime
     updated_at: datetime
 
-    reviews: List[Review] = []
+    reviews: Optional[List[Review]]
 
     class Config:
         orm_mode = True
+        getter_dict = LoadedGetterDict
 
 
-class ProductOut(BaseModel):
-    product: Product
-    rate: Optional[int]
+class CreateProduct(ProductBase):
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
-    class Config:
-        orm_mode = True
 
+class ImportRowError(BaseModel):
+    line: int
+    errors: List[str]
 
-class CreateProduct(ProductBase):
-    created_at: Optional[str] = None
-    updated_at: Optional[str] = None
+
+class ImportReport(BaseModel):
+    inserted: int
+    updated: int
+    failed: int
+    errors: List[ImportRowError]
 
 
 class UpdateProduct(BaseModel):
@@ -199,4 +257,5 @@ class UpdateProduct(BaseModel):
     description: Optional[str]
     price: Optional[float]
     image_url: Optional[str]
-    updated_at: Optional[str]
+    stock: Optional[conint(ge=0)]
+    updated_at: Optional[datetime]
@@ -0,0 +1,122 @@
+import logging
+import re
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import APIRouter
+from sqlalchemy import event
+
+from .config import settings
+from .metrics import route_template
+
+logger = logging.getLogger(__name__)
+
+# only mounted when SQL_DEBUG is on, see main.py
+router = APIRouter(
+    prefix="/debug",
+    tags=['Debug']
+)
+
+_PLACEHOLDER = r'\$\d+(?:::\w+(?:\(\d+\))?(?:\[\])?)?'
+_PLACEHOLDERS = re.compile(rf'{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})*')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement: str) -> str:
+    # IN lists render one placeholder per value; collapse them so they don't split a shape
+    return _WHITESPACE.sub(' ', _PLACEHOLDERS.sub('?', statement)).strip()
+
+
+class RequestTrace:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.started_at = datetime.now(timezone.utc)
+        self.shapes = {}
+
+    def add(self, statement: str, seconds: float):
+        shape = self.shapes.setdefault(statement_shape(statement), [0, 0.0])
+        shape[0] += 1
+        shape[1] += seconds
+
+    @property
+    def queries(self) -> int:
+        return sum(count for count, _ in self.shapes.values())
+
+    def repeated(self) -> list:
+        return [(shape, count) for shape, (count, _) in self.shapes.items()
+                if count >= settings.sql_debug_threshold]
+
+    def summary(self) -> dict:
+        return {
+            'method': self.method,
+            'path': self.path,
+            'route': self.route,
+            'status': self.status,
+            'started_at': self.started_at.isoformat(),
+            'queries': self.queries,
+            'db_ms': round(sum(seconds for _, seconds in self.shapes.values()) * 1000, 2),
+            'n_plus_one': [{'statement': shape, 'count': count} for shape, count in self.repeated()],
+            'statements': [{'statement': shape, 'count': count, 'ms': round(seconds * 1000, 2)}
+                           for shape, (count, seconds) in sorted(self.shapes.items(), key=lambda item: -item[1][0])],
+        }
+
+
+_trace: ContextVar[Optional[RequestTrace]] = ContextVar('sql_trace', default=None)
+_recent = deque(maxlen=settings.sql_debug_history)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._trace_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        trace = _trace.get()
+        if trace is not None:
+            trace.add(statement, time.perf_counter() - context._trace_start)
+
+
+class SQLTraceMiddleware:
+    # adds X-SQL-Queries / X-SQL-N-Plus-One to every response and keeps the last requests for /debug/sql;
+    # statements run while a streamed body is being sent only show up in /debug/sql
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(router.prefix):
+            return await self.app(scope, receive, send)
+
+        trace = RequestTrace(scope['method'], scope['path'])
+        token = _trace.set(trace)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                trace.status = message['status']
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'x-sql-queries', str(trace.queries).encode()),
+                    (b'x-sql-n-plus-one', str(len(trace.repeated())).encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _trace.reset(token)
+            trace.route = route_template(scope['app'], scope)
+            _recent.append(trace)
+            for shape, count in trace.repeated():
+                logger.warning("possible N+1 in %s %s: %d x %s",
+                               trace.method, trace.route, count, shape)
+
+
+@router.get('/sql')
+async def get_sql_traces(n_plus_one: bool = False, limit: int = 20):
+    traces = [trace for trace in reversed(_recent) if trace.repeated() or not n_plus_one]
+    return [trace.summary() for trace in traces[:limit]]
@@ -1,7 +1,20 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
+from .config import settings
+
+
+# min_rounds makes hashes below the configured cost "need update", so they get rehashed on login
+_pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto',
+                            bcrypt__default_rounds=settings.bcrypt_rounds, bcrypt__min_rounds=settings.bcrypt_rounds)
 
-_pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop
+_executor: Optional[ThreadPoolExecutor] = None
+_pending = 0
 
 
 def hash(password: str):
@@ -10,3 +23,28 @@ def hash(password: str):
 
 def verify(plaintext: str, hashed_password):
     return _pwd_context.verify(plaintext, hashed_password)
+
+
+async def _run_in_pool(func, *args):
+    global _executor, _pending
+    if _pending >= settings.password_hash_workers + settings.password_hash_queue_limit:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many authentication requests, try again later", headers={"Retry-After": "1"})
+    if _executor is None:
+        # created lazily so forked workers don't inherit the threads
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.password_hash_workers, thread_name_prefix='password-hash')
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run_in_pool(_pwd_context.hash, password)
+
+
+async def verify_password(plaintext: str, hashed_password) -> Tuple[bool, Optional[str]]:
+    # returns (valid, new_hash); new_hash is set when the stored hash uses outdated settings
+    return await _run_in_pool(_pwd_context.verify_and_update, plaintext, hashed_password)
@@ -0,0 +1,23 @@
+# gunicorn -c gunicorn.conf.py app.main:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'uvicorn.workers.UvicornWorker'
+# import the app once in the master; workers fork with it already loaded
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+accesslog = '-'
+# addresses whose X-Forwarded-For / X-Forwarded-Proto are trusted; '*' behind the platform's
+# router, where every connection comes from it. otherwise request.client is the router and
+# the per-IP login limit is shared by every client
+forwarded_allow_ips = os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1,::1')
+
+
+def post_fork(server, worker):
+    # each worker opens its own database connections
+    from app import database
+
+    database.dispose_inherited()
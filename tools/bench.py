@@ -0,0 +1,294 @@
+"""Load-test the API over a seeded database and report a comparable JSON baseline.
+
+    python -m tools.bench --products 100000 --users 20000 --orders 200000 --reviews 100000 \\
+        --concurrency 32 --duration 20 --output bench.json
+    python -m tools.bench --duration 20 --compare bench.json
+
+An empty database is seeded first (see tools.seed); a seeded one is reused as is.
+Each scenario runs --concurrency clients for --duration seconds against the app
+in-process, or against a running server with --url (which must use the same
+database). Per scenario it reports throughput, p50/p95/p99 latency and the mean
+number of SQL statements per request, read from the /metrics deltas (so against
+a server, run a single worker: every process keeps its own metrics).
+
+The flash scenario has every client buy one unit of the same product, stocked
+with --flash-stock units, until it sells out; its report checks that the units
+sold and the stock left add up, i.e. nothing was oversold; if they don't, the
+bench exits non-zero, so it can run as a check.
+
+The stuffing scenario sends wrong passwords for one account: past the login
+rate limit's burst they should come back as cheap 429s. In-process the limiter is
+on for that scenario only, so login keeps measuring bcrypt; against a server, run
+it with LOGIN_RATE_LIMIT=false for login and true for stuffing.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+from sqlalchemy import func, select, text
+
+from app import database, models
+from app.config import settings
+from tools.migrate import migrate
+from tools.seed import seed
+
+SEARCH_TERMS = ['vintage lamp', 'red shoe', 'organic mug', 'slim watch', 'sport backpack',
+                'classic chair', 'white sneaker', 'blue jacket', 'green shirt', 'headphones']
+SORTS = ['id', 'newest', 'price_asc', 'price_desc', 'rating']
+SAMPLE_SIZE = 2000
+
+
+async def browse(client: httpx.AsyncClient, rng: random.Random, data: dict, user: dict):
+    response = await client.get('/products/', params={'sort': rng.choice(SORTS), 'limit': 20})
+    yield response, (200,)
+    cursor = response.headers.get('X-Next-Cursor')
+    if cursor:
+        yield await client.get('/products/', params={'after': cursor, 'sort': response.request.url.params['sort'], 'limit': 20}), (200,)
+    yield await client.get(f"/products/{rng.choice(data['product_ids'])}"), (200,)
+
+
+async def search(client: httpx.AsyncClient, rng: random.Random, data: dict, user: dict):
+    yield await client.get('/products/', params={'search': rng.choice(SEARCH_TERMS), 'limit': 20}), (200,)
+
+
+async def login(client: httpx.AsyncClient, rng: random.Random, data: dict, user: dict):
+    yield await client.post('/login', data={'username': user['email'], 'password': data['password']}), (200,)
+
+
+async def stuffing(client: httpx.AsyncClient, rng: random.Random, data: dict, user: dict):
+    yield await client.post('/login', data={'username': data['users'][0][1], 'password': f"not-{data['password']}"}), (403, 429)
+
+
+async def checkout(client: httpx.AsyncClient, rng: random.Random, data: dict, user: dict):
+    products = rng.sample(data['product_ids'], rng.randint(1, 3))
+    items = [{'product_id': id, 'quantity': rng.randint(1, 3), 'price': data['prices'][id]} for id in products]
+    total = round(sum(item['price'] * item['quantity'] for item in items), 2)
+    now = datetime.now(timezone.utc).isoformat()
+    yield await client.post('/orders/', headers=user['headers'], json={
+        'total_price': total, 'shipping_address': f"{user['id']} Main St", 'order_items': items,
+        'payment': {'payment_date': now, 'amount': total}}), (201,)
+
+
+async def review(client: httpx.AsyncClient, rng: random.Random, data: dict, user: dict):
+    # each client has its own user, so a review/delete pair never collides with another client
+    product_id = rng.choice(data['product_ids'])
+    url = f'/products/{product_id}/reviews'
+    response = await client.post(url, headers=user['headers'], json={'comment': 'benchmark', 'rating': rng.randint(1, 5)})
+    yield response, (200, 400)
+    if response.status_code == 200:
+        yield await client.delete(url, headers=user['headers']), (204,)
+
+
+async def flash(client: httpx.AsyncClient, rng: random.Random, data: dict, user: dict):
+    id = data['product_ids'][0]
+    yield await client.post('/orders/', headers=user['headers'], json={
+        'shipping_address': f"{user['id']} Main St",
+        'order_items': [{'product_id': id, 'quantity': 1, 'price': data['prices'][id]}]}), (201, 409)
+
+
+SCENARIOS = {'browse': browse, 'search': search, 'login': login, 'stuffing': stuffing, 'checkout': checkout,
+             'review': review, 'flash': flash}
+
+
+def _percentile(samples: list, q: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _query_totals(metrics_text: str):
+    totals = {'sum': 0.0, 'count': 0.0}
+    for family in text_string_to_metric_families(metrics_text):
+        if family.name == 'http_request_db_queries':
+            for sample in family.samples:
+                if not sample.labels.get('route', '').startswith('/metrics'):
+                    for key in totals:
+                        if sample.name == f'http_request_db_queries_{key}':
+                            totals[key] += sample.value
+    return totals
+
+
+async def _client_user(client: httpx.AsyncClient, data: dict, index: int) -> dict:
+    id, email = data['users'][index % len(data['users'])]
+    response = await client.post('/login', data={'username': email, 'password': data['password']})
+    response.raise_for_status()
+    return {'id': id, 'email': email, 'headers': {'Authorization': f"Bearer {response.json()['access_token']}"}}
+
+
+async def run_scenario(client: httpx.AsyncClient, name: str, data: dict, concurrency: int, duration: float, seed_value: int,
+                       throttle: bool = False) -> dict:
+    users = [await _client_user(client, data, index) for index in range(concurrency)]
+    settings.login_rate_limit = throttle
+    latencies, errors = [], {}
+    before = _query_totals((await client.get('/metrics')).text)
+
+    async def worker(index: int):
+        rng = random.Random(seed_value * 1000 + index)
+        while time.perf_counter() < deadline:
+            requests = SCENARIOS[name](client, rng, data, users[index])
+            while True:
+                start = time.perf_counter()
+                try:
+                    response, expected = await requests.__anext__()
+                except StopAsyncIteration:
+                    break
+                latencies.append(time.perf_counter() - start)
+                if response.status_code not in expected:
+                    key = f'{response.request.method} {response.status_code}'
+                    errors[key] = errors.get(key, 0) + 1
+
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    settings.login_rate_limit = False
+
+    after = _query_totals((await client.get('/metrics')).text)
+    latencies.sort()
+    measured = after['count'] - before['count']
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+        **{f'p{int(q * 100)}_ms': round(_percentile(latencies, q) * 1000, 2) if latencies else None for q in (.5, .95, .99)},
+        # the logins that set up each client ran before the first snapshot, so they aren't counted
+        'queries_per_request': round((after['sum'] - before['sum']) / measured, 2) if measured else None,
+    }
+
+
+def _stock_sold(product_id: int, since: datetime):
+    with database.engine.connect() as conn:
+        stock = conn.execute(select(models.Product.stock).filter(models.Product.id == product_id)).scalar()
+        sold = conn.execute(select(func.coalesce(func.sum(models.OrderItem.quantity), 0)).filter(
+            models.OrderItem.product_id == product_id, models.OrderItem.created_at >= since)).scalar()
+    return stock, sold
+
+
+def _restock(product_id: int, stock: Optional[int]) -> datetime:
+    with database.engine.begin() as conn:
+        conn.execute(models.Product.__table__.update().filter(models.Product.id == product_id).values(stock=stock))
+        return conn.execute(text("SELECT now()")).scalar()
+
+
+def prepare(args) -> dict:
+    migrate()
+    with database.engine.begin() as conn:
+        if not conn.execute(text("SELECT EXISTS (SELECT 1 FROM products)")).scalar():
+            print(f"seeding {args.products} products, {args.users} users, {args.orders} orders, {args.reviews} reviews",
+                  file=sys.stderr)
+            seed(conn, args.products, args.users, args.orders, args.reviews, args.password)
+            seeded = True
+        else:
+            seeded = False
+    if seeded:
+        with database.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text("ANALYZE"))
+    with database.engine.connect() as conn:
+        sizes = {table: conn.execute(select(func.count()).select_from(model)).scalar()
+                 for table, model in (('products', models.Product), ('users', models.User),
+                                      ('orders', models.Order), ('reviews', models.Review))}
+        # an evenly spread, repeatable sample of the catalog
+        step = max(1, sizes['products'] // SAMPLE_SIZE)
+        prices = dict(conn.execute(select(models.Product.id, models.Product.price).filter(
+            models.Product.id % step == 0).limit(SAMPLE_SIZE)).all())
+        users = conn.execute(select(models.User.id, models.User.email).filter(
+            models.User.email.like('user%@example.com')).order_by(models.User.id).limit(SAMPLE_SIZE)).all()
+    if not users:
+        sys.exit('no seeded users (user<N>@example.com) in the database')
+    return {'sizes': sizes, 'prices': prices, 'product_ids': sorted(prices), 'users': users, 'password': args.password}
+
+
+async def run(args) -> dict:
+    data = prepare(args)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        from app.main import app
+        client = httpx.AsyncClient(app=app, base_url='http://bench', timeout=60)
+        # every in-process client has the same address, the limiter would throttle the setup logins
+        settings.login_rate_limit = False
+    results = {}
+    async with client:
+        for name in args.scenarios:
+            print(f"running {name} ...", file=sys.stderr)
+            if name == 'flash':
+                since = _restock(data['product_ids'][0], args.flash_stock)
+            results[name] = await run_scenario(client, name, data, args.concurrency, args.duration, args.seed,
+                                               throttle=name == 'stuffing' and not args.url)
+            if name == 'flash':
+                left, sold = _stock_sold(data['product_ids'][0], since)
+                results[name]['stock'] = {'initial': args.flash_stock, 'sold': sold, 'left': left,
+                                          'consistent': left >= 0 and sold + left == args.flash_stock}
+                # back to untracked, so a sold-out product doesn't fail the other scenarios
+                _restock(data['product_ids'][0], None)
+    await database.async_engine.dispose()
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'meta': {'commit': commit or None, 'date': datetime.now(timezone.utc).isoformat(),
+                 'target': args.url or 'in-process', 'concurrency': args.concurrency,
+                 'duration': args.duration, 'seed': args.seed, 'dataset': data['sizes']},
+        'scenarios': results,
+    }
+
+
+def compare(report: dict, baseline: dict):
+    keys = ['throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request']
+    print(f"{'scenario':<10}" + ''.join(f'{key:>26}' for key in keys))
+    for name, result in report['scenarios'].items():
+        old = baseline['scenarios'].get(name, {})
+        cells = []
+        for key in keys:
+            new_value, old_value = result.get(key), old.get(key)
+            change = f' ({(new_value - old_value) / old_value:+.0%})' if new_value is not None and old_value else ''
+            cells.append(f'{old_value} -> {new_value}{change}')
+        print(f'{name:<10}' + ''.join(f'{cell:>26}' for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--reviews', type=int, default=10000)
+    parser.add_argument('--password', default='password',
+                        help='password of the seeded users')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per scenario')
+    parser.add_argument('--flash-stock', type=int, default=500,
+                        help='units of the flash scenario product')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seeds the request mix, so runs are repeatable')
+    parser.add_argument('--url', help='benchmark a running server instead of the app in-process')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='print the change against a previous JSON report')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report, json.load(file))
+    # after the report is written, so a failed run still leaves it to look at
+    stock = report['scenarios'].get('flash', {}).get('stock')
+    if stock and not stock['consistent']:
+        sys.exit(f"flash: stock doesn't add up, {stock['sold']} sold + {stock['left']} left != {stock['initial']} stocked")
+
+
+if __name__ == '__main__':
+    main()
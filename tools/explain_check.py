@@ -0,0 +1,113 @@
+"""Fail if the main query of any route falls back to a sequential scan on a large table.
+
+    python -m tools.seed --products 200000 --users 50000 --orders 200000 --reviews 200000
+    python -m tools.explain_check --threshold 1000
+
+The routes are driven in-process against the configured (seeded) database. Every
+SELECT/UPDATE/DELETE they run is captured and EXPLAINed with the same parameters,
+and a Seq Scan on a table with more than --threshold rows is reported.
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+import httpx
+from sqlalchemy import event, select, text
+
+from app import database, models, oauth2
+from app.main import app
+
+
+def _checks(product_id: int, user_id: int, order_id: int, cursor: str):
+    return [
+        ('GET', '/products/', {}),
+        ('GET', '/products/', {'params': {'sort': 'newest'}}),
+        ('GET', '/products/', {'params': {'sort': 'price_desc', 'min_rating': 3}}),
+        ('GET', '/products/', {'params': {'sort': 'rating'}}),
+        ('GET', '/products/', {'params': {'after': cursor}}),
+        ('GET', '/products/', {'params': {'search': 'vintage lamp'}}),
+        ('GET', f'/products/{product_id}', {'params': {'expand': 'reviews'}}),
+        ('GET', f'/users/{user_id}', {'params': {'expand': 'orders,payments,reviews'}}),
+        ('GET', f'/orders/{order_id}', {}),
+        ('GET', f'/orders/payments/{order_id}', {'auth': 'client'}),
+        ('POST', f'/products/{product_id}/reviews', {'auth': 'client', 'json': {'comment': 'explain', 'rating': 5}}),
+        ('PUT', f'/products/{product_id}/reviews', {'auth': 'client', 'json': {'rating': 4}}),
+        ('DELETE', f'/products/{product_id}/reviews', {'auth': 'client'}),
+        ('PUT', f'/orders/{order_id}', {'auth': 'admin', 'json': {'status': 'arrived'}}),
+        ('POST', '/login', {'data': {'username': 'user1@example.com', 'password': 'password'}}),
+        ('POST', '/login', {'data': {'username': 'admin', 'password': 'password'}}),
+    ]
+
+
+def _seq_scans(plan):
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from _seq_scans(child)
+
+
+async def run(threshold: int) -> int:
+    async with database.AsyncSessionLocal() as db:
+        # a user with a paid order, and a product they have not reviewed yet
+        user_id, order_id = (await db.execute(select(models.Payment.user_id, models.Payment.order_id).order_by(
+            models.Payment.order_id).limit(1))).one()
+        admin_id = await db.scalar(select(models.Admin.id).order_by(models.Admin.id))
+        product_id = await db.scalar(select(models.Product.id).filter(~models.Product.reviews.any(
+            models.Review.user_id == user_id)).order_by(models.Product.id))
+        sizes = dict((await db.execute(text(
+            "SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')"))).all())
+    tokens = {
+        'client': oauth2.create_access_token({'user_id': user_id, 'role': 'client'}),
+        'admin': oauth2.create_access_token({'user_id': admin_id, 'role': 'admin'}),
+    }
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'WITH'):
+            captured.append((statement, parameters))
+
+    failures = 0
+    async with httpx.AsyncClient(app=app, base_url='http://explain') as client:
+        first_page = await client.get('/products/', params={'limit': 10})
+        checks = _checks(product_id, user_id, order_id,
+                         first_page.headers.get('X-Next-Cursor', ''))
+        for method, url, kwargs in checks:
+            auth = kwargs.pop('auth', None)
+            headers = {'Authorization': f'Bearer {tokens[auth]}'} if auth else {}
+            captured.clear()
+            event.listen(database.async_engine.sync_engine,
+                         'before_cursor_execute', capture)
+            try:
+                response = await client.request(method, url, headers=headers, **kwargs)
+            finally:
+                event.remove(database.async_engine.sync_engine,
+                             'before_cursor_execute', capture)
+            print(f"{method} {response.request.url} -> {response.status_code}")
+
+            async with database.async_engine.connect() as conn:
+                for statement, parameters in captured:
+                    plan = (await conn.exec_driver_sql(
+                        'EXPLAIN (FORMAT JSON) ' + statement, parameters)).scalar()
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    for table in _seq_scans(plan[0]['Plan']):
+                        if sizes.get(table, 0) > threshold:
+                            failures += 1
+                            print(f"  Seq Scan on {table} ({int(sizes[table])} rows):\n"
+                                  f"    {' '.join(statement.split())}")
+    print('FAILED' if failures else 'OK', f"({failures} sequential scans above {threshold} rows)")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threshold', type=int, default=1000,
+                        help='largest table size a sequential scan is allowed on')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.threshold)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""Bulk-load products from a CSV or NDJSON supplier feed.
+
+    python -m tools.import_products feed.csv
+    python -m tools.import_products feed.ndjson --dry-run
+
+Columns/keys are those of POST /products/ plus an optional id: rows with an id
+update that product, the rest are inserted. Invalid rows are skipped and listed;
+the exit status is 1 if any row failed. Running API workers see the changes once
+their cached product responses expire (PRODUCT_CACHE_TTL).
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from app import database, importer
+
+
+async def run(path: str, format: str, dry_run: bool) -> int:
+    with open(path, encoding='utf-8-sig', newline='') as file:
+        async with database.async_engine.connect() as conn:
+            report, _ = await importer.import_products(conn, importer.read_records(file, format))
+            if dry_run:
+                await conn.rollback()
+            else:
+                await conn.commit()
+    await database.async_engine.dispose()
+    for error in report['errors']:
+        print(f"line {error['line']}: {'; '.join(error['errors'])}", file=sys.stderr)
+    print(json.dumps({key: report[key] for key in ('inserted', 'updated', 'failed')}))
+    return 1 if report['failed'] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=['csv', 'ndjson'],
+                        help='defaults to csv for *.csv files, ndjson otherwise')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='validate and load, then roll back')
+    args = parser.parse_args()
+    format = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+    sys.exit(asyncio.run(run(args.path, format, args.dry_run)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Add the upcoming order partitions, archive closed orders and expire idempotency keys.
+
+    python -m tools.maintenance partitions --months 3
+    python -m tools.maintenance archive --older-than 365
+    python -m tools.maintenance expire-keys
+
+orders, order_items and payments are range partitioned by order_date, one
+partition per month. `partitions` creates the ones for the current month and the
+next --months; run it from cron at least monthly (tools.migrate also runs it on
+every deploy). An order dated outside every partition lands in the default one;
+creating the partition for its month later moves it over.
+
+`archive` moves arrived and cancelled orders dated before the cutoff, with their
+items and payments, into the yearly partitions of the *_archive tables, one batch
+per transaction. GET /orders/{id} still finds them there.
+
+`expire-keys` deletes the Idempotency-Key records of POST /orders/ older than
+IDEMPOTENCY_KEY_TTL; run it from cron too.
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.exc import DBAPIError
+
+from app import database, models
+from app.config import settings
+
+MONTHS_AHEAD = 3
+# final statuses, see ORDER_TRANSITIONS in app/routers/order.py
+CLOSED = ('arrived', 'cancelled')
+LIVE = [models.Order.__table__, models.OrderItem.__table__, models.Payment.__table__]
+ARCHIVE = [models.ArchivedOrder.__table__, models.ArchivedOrderItem.__table__, models.ArchivedPayment.__table__]
+
+
+def _month(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(month: datetime, months: int) -> datetime:
+    years, index = divmod(month.month - 1 + months, 12)
+    return month.replace(year=month.year + years, month=index + 1)
+
+
+def _park_default_rows(conn, tables, start: datetime, end: datetime) -> int:
+    # a partition can't be created while the default one holds rows of its range (the partitions
+    # were missing when they were written): move them to temporary tables until it exists.
+    # items and payments first, deleting the orders would cascade to them
+    bounds = {'start': start, 'end': end}
+    parked = 0
+    for table in reversed(tables):
+        conn.execute(text(f"CREATE TEMPORARY TABLE {table.name}_parked (LIKE {table.name}_default)"))
+        parked += conn.execute(text(f"""
+            WITH moved AS (DELETE FROM {table.name}_default WHERE order_date >= :start AND order_date < :end RETURNING *)
+            INSERT INTO {table.name}_parked SELECT * FROM moved"""), bounds).rowcount
+    return parked
+
+
+def _restore_parked_rows(conn, tables):
+    for table in tables:
+        conn.execute(text(f"INSERT INTO {table.name} SELECT * FROM {table.name}_parked"))
+        conn.execute(text(f"DROP TABLE {table.name}_parked"))
+
+
+def _create_partitions(conn, tables, suffix: str, start: datetime, end: datetime) -> bool:
+    # all of an order's tables or none, so an order and its items always share a date range
+    names = [f'{table.name}_{suffix}' for table in tables]
+    if all(conn.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar() for name in names):
+        return False
+    try:
+        with conn.begin_nested():
+            parked = _park_default_rows(conn, tables, start, end)
+            for table, name in zip(tables, names):
+                conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table.name} "
+                                  f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"))
+            _restore_parked_rows(conn, tables)
+    except DBAPIError as error:
+        print(f"skipped {', '.join(names)}: {str(error.orig).strip().splitlines()[0]}", file=sys.stderr)
+        return False
+    if parked:
+        print(f"moved {parked} rows out of the default partitions into {', '.join(names)}", file=sys.stderr)
+    return True
+
+
+def create_partitions(conn, months: int = MONTHS_AHEAD, first: datetime = None) -> list:
+    # creating a partition locks the parent table, don't queue up behind a long transaction
+    conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+    month = _month(first or datetime.now(timezone.utc))
+    last = _add_months(_month(datetime.now(timezone.utc)), months)
+    created = []
+    while month <= last:
+        suffix = f'p{month:%Y_%m}'
+        if _create_partitions(conn, LIVE, suffix, month, _add_months(month, 1)):
+            created.append(suffix)
+        month = _add_months(month, 1)
+    return created
+
+
+def archive(cutoff: datetime, batch_size: int) -> int:
+    orders = models.Order.__table__
+    closed = [orders.c.status.in_(CLOSED), orders.c.order_date < cutoff]
+    with database.engine.begin() as conn:
+        conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+        oldest = conn.execute(select(orders.c.order_date).filter(*closed).order_by(orders.c.order_date).limit(1)).scalar()
+        if oldest is None:
+            return 0
+        for year in range(oldest.astimezone(timezone.utc).year, cutoff.year + 1):
+            _create_partitions(conn, ARCHIVE, f'p{year}', datetime(year, 1, 1, tzinfo=timezone.utc),
+                               datetime(year + 1, 1, 1, tzinfo=timezone.utc))
+
+    moved = 0
+    while True:
+        with database.engine.begin() as conn:
+            # skip orders a request is updating right now, a later run picks them up
+            ids = conn.execute(select(orders.c.id).filter(*closed).limit(batch_size).with_for_update(
+                skip_locked=True)).scalars().all()
+            if not ids:
+                return moved
+            for live, archived in zip(LIVE, ARCHIVE):
+                order_id = live.c.id if live is orders else live.c.order_id
+                columns = [column.name for column in archived.c]
+                conn.execute(insert(archived).from_select(columns, select(*(live.c[name] for name in columns)).filter(
+                    order_id.in_(ids), live.c.order_date < cutoff)))
+            # the items and payments go with it (ON DELETE CASCADE)
+            conn.execute(delete(orders).filter(orders.c.id.in_(ids), orders.c.order_date < cutoff))
+        moved += len(ids)
+        print(f"archived {moved} orders", file=sys.stderr)
+
+
+def expire_keys(batch_size: int) -> int:
+    keys = models.IdempotencyKey.__table__
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.idempotency_key_ttl)
+    deleted = 0
+    while True:
+        # short batches over the created_at index, a request claiming a key never waits long
+        with database.engine.begin() as conn:
+            batch = select(keys.c.user_id, keys.c.key).filter(keys.c.created_at < cutoff).limit(
+                batch_size).with_for_update(skip_locked=True).subquery()
+            count = conn.execute(delete(keys).filter(keys.c.user_id == batch.c.user_id, keys.c.key == batch.c.key)).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    partitions = commands.add_parser('partitions', help='create the monthly partitions up to --months ahead')
+    partitions.add_argument('--months', type=int, default=MONTHS_AHEAD)
+    archiving = commands.add_parser('archive', help='move closed orders older than --older-than days to the archive')
+    archiving.add_argument('--older-than', type=int, default=365, metavar='DAYS')
+    archiving.add_argument('--batch-size', type=int, default=1000)
+    expiring = commands.add_parser('expire-keys', help='delete idempotency keys older than IDEMPOTENCY_KEY_TTL')
+    expiring.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.command == 'partitions':
+        with database.engine.begin() as conn:
+            created = create_partitions(conn, args.months)
+        print(f"created {len(created)} monthly partitions" + (f": {', '.join(created)}" if created else ''))
+    elif args.command == 'expire-keys':
+        print(f"deleted {expire_keys(args.batch_size)} expired idempotency keys")
+    else:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=args.older_than)
+        print(f"archived {archive(cutoff, args.batch_size)} orders dated before {cutoff:%Y-%m-%d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Bring the database schema up to the Alembic head; run once per deploy, before the web workers.
+
+    python -m tools.migrate
+
+An empty database gets the current models in one create_all and is stamped at
+head, instead of replaying every migration. Otherwise pending migrations are
+applied with `alembic upgrade head`. Either way the monthly order partitions for
+the coming months are created (see tools.maintenance).
+"""
+import argparse
+import sys
+
+from alembic import command
+from sqlalchemy import inspect
+
+from app import database, models
+from app.migrations import alembic_config
+from tools.maintenance import create_partitions
+
+
+def _schema() -> str:
+    config = alembic_config()
+    tables = inspect(database.engine).get_table_names()
+    if not tables:
+        models.Base.metadata.create_all(bind=database.engine)
+        command.stamp(config, 'head')
+        return 'created the schema and stamped it at head'
+    if 'alembic_version' not in tables:
+        sys.exit("the database has tables but no alembic_version; stamp the revision it matches "
+                 "with `alembic stamp <revision>` first")
+    command.upgrade(config, 'head')
+    return 'upgraded to head'
+
+
+def migrate() -> str:
+    done = _schema()
+    with database.engine.begin() as conn:
+        created = create_partitions(conn)
+    return f'{done}, {len(created)} new order partitions'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+    print(migrate())
+
+
+if __name__ == '__main__':
+    main()
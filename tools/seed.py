@@ -0,0 +1,103 @@
+"""Fill an empty database with synthetic catalog, user, order and review data.
+
+    python -m tools.seed --products 100000 --users 20000 --orders 200000 --reviews 100000
+
+Every seeded user and admin can log in with the password given by --password.
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from app import database, utils
+from tools.maintenance import create_partitions
+from tools.migrate import migrate
+
+
+ADJECTIVES = "ARRAY['red','blue','green','black','white','vintage','classic','sport','slim','organic']"
+NOUNS = "ARRAY['shoe','shirt','jacket','watch','lamp','backpack','mug','headphones','chair','sneaker']"
+
+
+def seed(conn, products: int, users: int, orders: int, reviews: int, password: str):
+    hashed = utils.hash(password)
+    conn.execute(text("INSERT INTO admins (username, password) VALUES ('admin', :password)"),
+                 {'password': hashed})
+    conn.execute(text("""
+        INSERT INTO users (name, email, phone, password, address)
+        SELECT 'user ' || g, 'user' || g || '@example.com', '555-' || g, :password, g || ' Main St'
+        FROM generate_series(1, :n) AS g
+    """), {'n': users, 'password': hashed})
+    conn.execute(text(f"""
+        INSERT INTO products (name, description, price, image_url, created_at)
+        SELECT ({ADJECTIVES})[1 + g % 10] || ' ' || ({NOUNS})[1 + (g / 10) % 10] || ' ' || g,
+               'A ' || ({ADJECTIVES})[1 + (g / 100) % 10] || ' ' || ({NOUNS})[1 + g % 10] || ' for everyday use',
+               round((1 + random() * 199)::numeric, 2), 'https://example.com/products/' || g || '.jpg',
+               now() - (g % 1000) * interval '1 hour'
+        FROM generate_series(1, :n) AS g
+    """), {'n': products})
+    # spread each user's reviews over the catalog; the odd duplicate pair is skipped
+    conn.execute(text("""
+        INSERT INTO reviews (product_id, user_id, comment, rating)
+        SELECT p.first + (g + (g / :users) * 7919) % :products, u.first + g % :users, 'review ' || g, 1 + g % 5
+        FROM generate_series(0, :n - 1) AS g,
+             (SELECT min(id) AS first FROM products) AS p, (SELECT min(id) AS first FROM users) AS u
+        ON CONFLICT DO NOTHING
+    """), {'n': reviews, 'products': products, 'users': users})
+    conn.execute(text("""
+        UPDATE products
+        SET rating_avg = r.rating_avg, rating_count = r.rating_count
+        FROM (SELECT product_id, avg(rating) AS rating_avg, count(*) AS rating_count
+              FROM reviews GROUP BY product_id) AS r
+        WHERE products.id = r.product_id
+    """))
+    # the orders span two years back, give each month its partition
+    create_partitions(conn, first=datetime.now(timezone.utc) - timedelta(days=730))
+    conn.execute(text("""
+        INSERT INTO orders (user_id, order_date, total_price, shipping_address, status)
+        SELECT u.first + g % :users, now() - (g % 730) * interval '1 day', 0, g || ' Main St',
+               (ARRAY['pending', 'in_delivery', 'arrived', 'cancelled'])[1 + g % 4]
+        FROM generate_series(1, :n) AS g, (SELECT min(id) AS first FROM users) AS u
+    """), {'n': orders, 'users': users})
+    # one to three distinct products per order
+    conn.execute(text("""
+        INSERT INTO order_items (order_id, order_date, product_id, quantity, price)
+        SELECT o.id, o.order_date, products.id, 1 + k, products.price
+        FROM orders AS o
+        CROSS JOIN LATERAL generate_series(1, 1 + o.id % 3) AS k
+        JOIN products ON products.id = (SELECT min(id) FROM products) + (o.id * 3 + k) % :products
+    """), {'products': products})
+    conn.execute(text("""
+        UPDATE orders
+        SET total_price = i.total
+        FROM (SELECT order_id, order_date, sum(price * quantity) AS total FROM order_items GROUP BY order_id, order_date) AS i
+        WHERE orders.id = i.order_id AND orders.order_date = i.order_date
+    """))
+    conn.execute(text("""
+        INSERT INTO payments (user_id, order_id, order_date, payment_date, amount)
+        SELECT user_id, id, order_date, order_date, total_price FROM orders WHERE status <> 'pending'
+    """))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--reviews', type=int, default=10000)
+    parser.add_argument('--password', default='password')
+    args = parser.parse_args()
+
+    migrate()
+    with database.engine.begin() as conn:
+        if conn.execute(text("SELECT EXISTS (SELECT 1 FROM products)")).scalar():
+            parser.error("the database already has products, seed an empty one")
+        seed(conn, args.products, args.users,
+             args.orders, args.reviews, args.password)
+    with database.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text("ANALYZE"))
+    print(f"seeded {args.products} products, {args.users} users, "
+          f"{args.orders} orders and {args.reviews} reviews")
+
+
+if __name__ == '__main__':
+    main()